@@ -76,6 +76,16 @@ export class CdkStreamChatbotStack extends cdk.Stack {
       partitionKey: { name: 'request_id', type: dynamodb.AttributeType.STRING },
     });
 
+    // DynamoDB for the response cache which is shared by lambda containers
+    const cacheTableName = `db-response-cache-for-${projectName}`;
+    const cacheDataTable = new dynamodb.Table(this, `db-response-cache-for-${projectName}`, {
+      tableName: cacheTableName,
+      partitionKey: { name: 'cache_key', type: dynamodb.AttributeType.STRING },
+      billingMode: dynamodb.BillingMode.PAY_PER_REQUEST,
+      timeToLiveAttribute: 'ttl',
+      removalPolicy: cdk.RemovalPolicy.DESTROY,
+    });
+
     // copy web application files into s3 bucket
     new s3Deploy.BucketDeployment(this, `upload-HTML-for-${projectName}`, {
       sources: [s3Deploy.Source.asset("../html/")],
@@ -412,12 +422,18 @@ export class CdkStreamChatbotStack extends cdk.Stack {
         s3_prefix: s3_prefix,
         path: 'https://'+distribution.domainName+'/',   
         callLogTableName: callLogTableName,
-        connection_url: connection_url
+        connection_url: connection_url,
+        stream_mode: 'delta',  // delta or snapshot
+        cacheTableName: cacheTableName,
+        document_cache_prefix: 'cache/',  // the chunks and the summaries of the documents
+        vector_index_prefix: 'cache/index/'  // the embeddings of the chunks for the questions
       }
     });     
     lambdaChatWebsocket.grantInvoke(new iam.ServicePrincipal('apigateway.amazonaws.com'));  
     s3Bucket.grantRead(lambdaChatWebsocket); // permission for s3
+    s3Bucket.grantPut(lambdaChatWebsocket, 'cache/*'); // permission for the document cache
     callLogDataTable.grantReadWriteData(lambdaChatWebsocket); // permission for dynamo 
+    cacheDataTable.grantReadWriteData(lambdaChatWebsocket); // permission for dynamo 
     
     new cdk.CfnOutput(this, 'function-chat-ws-arn', {
       value: lambdaChatWebsocket.functionArn,
@@ -461,6 +477,15 @@ export class CdkStreamChatbotStack extends cdk.Stack {
       target: `integrations/${cfnIntegration.ref}`,      
     }); 
 
+    new apigatewayv2.CfnRoute(this, `api-route-for-${projectName}-resume`, {
+      apiId: websocketapi.attrApiId,
+      routeKey: "resume",  // the client resumes a streamed answer after reconnecting
+      apiKeyRequired: false,
+      authorizationType: "NONE",
+      operationName: 'resume',
+      target: `integrations/${cfnIntegration.ref}`,      
+    }); 
+
     new apigatewayv2.CfnStage(this, `api-stage-for-${projectName}`, {
       apiId: websocketapi.attrApiId,
       stageName: stage
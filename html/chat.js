@@ -71,6 +71,9 @@ function sendMessage(message) {
         webSocket.send(JSON.stringify(message));     
         console.log('message: ', message);   
 
+        if(message.action == undefined) {
+            streaming.put(message.request_id, message);  // resumed if the connection drops before the answer
+        }
         return true;
     }     
 }
@@ -97,6 +100,7 @@ function connect(endpoint, type) {
         console.log('connected...');
         isConnected = true;
 
+        let resent = [];  // sent again as new requests, which are not resumed
         if(undelivered.size() && retry_count>0) {
             let keys = undelivered.getKeys();
             console.log('retry undelived messags!');            
@@ -109,6 +113,7 @@ function connect(endpoint, type) {
                 if(!sendMessage(message)) break;
                 else {
                     undelivered.remove(message.request_id)
+                    resent.push(message.request_id);
                 }
             }
             retry_count--;
@@ -117,6 +122,10 @@ function connect(endpoint, type) {
             retry_count = 3
         }
 
+        if(type == 'reconnect') {
+            resumeStreams(resent);
+        }
+
         if(type == 'initial')
             setInterval(ping, 40000);  // ping interval: 40 seconds
     };
@@ -135,6 +144,9 @@ function connect(endpoint, type) {
                 feedback.style.display = 'none';          
                 console.log('received message: ', response.msg);                  
                 addReceivedMessage(response.request_id, response.msg);  
+                clearDeltaMessage(response.request_id);
+                streaming.remove(response.request_id);
+                feedback.innerHTML = '<i>typing a message...</i>';
             }                
             else if(response.status == 'istyping') {
                 feedback.style.display = 'inline';
@@ -142,8 +154,21 @@ function connect(endpoint, type) {
             }
             else if(response.status == 'proceeding') {
                 feedback.style.display = 'none';
+                deltaSeq.put(response.request_id, response.seq+1);  // for the resume
                 addReceivedMessage(response.request_id, response.msg);  
             }                
+            else if(response.status == 'resume') {
+                feedback.style.display = 'none';
+                resumeDeltaMessage(response.request_id, response.seq, response.msg);  
+            }                
+            else if(response.status == 'progress') {
+                feedback.style.display = 'inline';
+                feedback.innerHTML = `<i>${response.msg}</i>`;
+            }
+            else if(response.status == 'delta') {
+                feedback.style.display = 'none';
+                addDeltaMessage(response.request_id, response.seq, response.msg);  
+            }                
             else if(response.status == 'debug') {
                 feedback.style.display = 'none';
                 console.log('debug: ', response.msg);
@@ -152,6 +177,7 @@ function connect(endpoint, type) {
             }          
             else if(response.status == 'error') {
                 feedback.style.display = 'none';
+                streaming.remove(response.request_id);
                 console.log('error: ', response.msg);
                 addNotifyMessage(response.msg);
             }   
@@ -456,6 +482,87 @@ function addReceivedMessage(requestId, msg) {
     index++;
 }
 
+// reassemble the streamed message from the delta messages which are ordered by seq
+let deltaText = new HashMap();
+let deltaSeq = new HashMap();
+let deltaPending = new HashMap();
+function addDeltaMessage(requestId, seq, msg) {
+    let expected = deltaSeq.get(requestId);
+    if(expected == undefined) {
+        expected = 0;
+        deltaText.put(requestId, "");
+        deltaPending.put(requestId, {});
+    }
+    if(seq < expected) {
+        console.log('duplicated delta: ', seq);
+        return;
+    }
+
+    let pending = deltaPending.get(requestId);
+    pending[seq] = msg;
+
+    let text = deltaText.get(requestId);
+    while(pending[expected] != undefined) {
+        text += pending[expected];
+        delete pending[expected];
+        expected++;
+    }
+    deltaText.put(requestId, text);
+    deltaSeq.put(requestId, expected);
+
+    addReceivedMessage(requestId, text);
+}
+
+function clearDeltaMessage(requestId) {
+    deltaText.remove(requestId);
+    deltaSeq.remove(requestId);
+    deltaPending.remove(requestId);
+}
+
+function resumeDeltaMessage(requestId, seq, msg) {
+    // the text up to seq which was sent again since the kept messages didn't cover the missing ones
+    let pending = deltaPending.get(requestId);
+    if(pending == undefined) {
+        pending = {};
+        deltaPending.put(requestId, pending);
+    }
+    for(let s in pending) {
+        if(Number(s) < seq) delete pending[s];
+    }
+
+    let text = msg;
+    while(pending[seq] != undefined) {
+        text += pending[seq];
+        delete pending[seq];
+        seq++;
+    }
+    deltaText.put(requestId, text);
+    deltaSeq.put(requestId, seq);
+
+    addReceivedMessage(requestId, text);
+}
+
+let streaming = new HashMap();  // request_id: the requests which are not answered yet
+function resumeStreams(resent) {
+    // asks for the rest of the answers which were being streamed when the connection dropped
+    let keys = streaming.getKeys();
+    for(i in keys) {
+        let message = streaming.get(keys[i]);
+        if(resent.includes(message.request_id) || undelivered.get(message.request_id)) continue;  // sent again as a new request
+
+        let expected = deltaSeq.get(message.request_id);
+        let resume = {
+            "action": "resume",
+            "user_id": message.user_id,
+            "request_id": message.request_id,
+            "request_time": message.request_time,
+            "last_seq": expected == undefined ? -1 : expected-1
+        };
+        webSocket.send(JSON.stringify(resume));
+        console.log('resume: ', resume);
+    }
+}
+
 function addNotifyMessage(msg) {
     console.log("index:", index);   
 
@@ -499,6 +606,21 @@ attachFile.addEventListener('click', function(){
             else if(ext == 'csv') {
                 contentType = 'text/csv'
             }
+            else if(ext == 'md') {
+                contentType = 'text/markdown'
+            }
+            else if(ext == 'html') {
+                contentType = 'text/html'
+            }
+            else if(ext == 'json') {
+                contentType = 'application/json'
+            }
+            else if(ext == 'docx') {
+                contentType = 'application/vnd.openxmlformats-officedocument.wordprocessingml.document'
+            }
+            else if(ext == 'pptx') {
+                contentType = 'application/vnd.openxmlformats-officedocument.presentationml.presentation'
+            }
 
             let current = new Date();
             let datastr = getDate(current);
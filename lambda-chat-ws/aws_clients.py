@@ -0,0 +1,79 @@
+import os
+import threading
+import boto3
+
+from botocore.config import Config
+
+# boto3 clients are created once per container and shared by every invocation,
+# so the session, credential and endpoint resolution and the TLS connections are reused.
+default_config = Config(
+    max_pool_connections = int(os.environ.get('aws_max_pool_connections', '20')),
+    tcp_keepalive = True,
+    connect_timeout = int(os.environ.get('aws_connect_timeout', '5')),
+    read_timeout = int(os.environ.get('aws_read_timeout', '60')),
+    retries = {
+        'max_attempts': 3,
+        'mode': 'adaptive'
+    }
+)
+
+# per service settings which are merged into the default config
+service_config = {
+    'bedrock-runtime': Config(
+        read_timeout = int(os.environ.get('bedrock_read_timeout', '300'))  # a stream can be open until the lambda timeout
+    ),
+    'apigatewaymanagementapi': Config(
+        connect_timeout = 2,
+        read_timeout = 10
+    ),
+}
+
+session = boto3.session.Session()
+lock = threading.Lock()  # boto3 sessions are not thread safe while creating clients
+clients = dict()
+resources = dict()
+
+def get_config(service_name, config=None):
+    merged = default_config
+    if service_name in service_config:
+        merged = merged.merge(service_config[service_name])
+    if config is not None:
+        merged = merged.merge(config)
+    return merged
+
+def config_key(config):
+    # the options which were given to the config, in a hashable form
+    return repr(sorted(config._user_provided_options.items()))
+
+def get_client(service_name, region_name=None, endpoint_url=None, config=None):
+    # a client with a config of its own is another client than the one of the default config, so a caller which
+    # comes first does not decide the retries and the timeouts of the others
+    key = (service_name, region_name, endpoint_url) if config is None else (service_name, region_name, endpoint_url, config_key(config))
+    client = clients.get(key)
+    if client is None:
+        with lock:
+            client = clients.get(key)
+            if client is None:
+                client = session.client(
+                    service_name=service_name,
+                    region_name=region_name,
+                    endpoint_url=endpoint_url,
+                    config=get_config(service_name, config)
+                )
+                clients[key] = client
+    return client
+
+def get_resource(service_name, region_name=None):
+    key = (service_name, region_name)
+    resource = resources.get(key)
+    if resource is None:
+        with lock:
+            resource = resources.get(key)
+            if resource is None:
+                resource = session.resource(
+                    service_name=service_name,
+                    region_name=region_name,
+                    config=get_config(service_name)
+                )
+                resources[key] = resource
+    return resource
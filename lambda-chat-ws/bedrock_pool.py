@@ -0,0 +1,229 @@
+import time
+import threading
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import logger
+
+# the errors which another attempt or another endpoint can get over. ChatBedrock wraps the botocore error
+# into a ValueError, so the error code is also looked up in the message.
+RETRYABLE_ERRORS = ['ThrottlingException', 'ServiceUnavailableException', 'ModelNotReadyException', 'InternalServerException',
+                    'ModelTimeoutException', 'TooManyRequestsException', 'ReadTimeoutError', 'ConnectTimeoutError', 'EndpointConnectionError']
+
+def is_retryable(error):
+    if isinstance(error, CircuitOpenError):
+        return True
+    code = getattr(error, 'response', {}).get('Error', {}).get('Code')
+    if code in RETRYABLE_ERRORS:
+        return True
+    message = str(error)
+    return any(name in message for name in RETRYABLE_ERRORS)
+
+class CircuitOpenError(Exception):
+    pass
+
+class CircuitBreaker:
+    # closed: the requests pass. open: the requests fail fast until reset_timeout has passed.
+    # half open: one trial request decides whether it is closed again or opened again.
+    def __init__(self, failure_threshold, reset_timeout):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = 'closed'
+        self.failures = 0
+        self.opened = 0.0
+        self.lock = threading.Lock()
+
+    def available(self):
+        return self.state == 'closed' or (self.state == 'open' and time.time() - self.opened >= self.reset_timeout)
+
+    def allow(self):
+        with self.lock:
+            if self.state == 'closed':
+                return True
+            if self.state == 'open' and time.time() - self.opened >= self.reset_timeout:
+                self.state = 'half_open'  # only this request is let through
+                return True
+            return False
+
+    def success(self):
+        with self.lock:
+            self.state = 'closed'
+            self.failures = 0
+
+    def failure(self):
+        with self.lock:
+            self.failures = self.failures + 1
+            if self.state == 'half_open' or self.failures >= self.failure_threshold:
+                if self.state != 'open':
+                    logger.warning('circuit is opened', failures=self.failures)
+                self.state = 'open'
+                self.opened = time.time()
+
+class Endpoint:
+    # a chat model of a region or a model with its circuit breaker and the latency of the recent requests by the kind
+    # of the call, since the time to the first chunk of a stream is far shorter than the whole answer of an invoke
+    def __init__(self, name, chat, breaker, window=200, model=None):
+        self.name = name
+        self.chat = chat
+        self.breaker = breaker
+        self.model = model  # the model id, when the endpoints of the pool serve different models
+        self.window = window
+        self.latencies = dict()  # kind: deque
+        self.ewma = dict()  # kind: seconds
+
+    def observe(self, kind, latency):
+        self.latencies.setdefault(kind, deque(maxlen=self.window)).append(latency)
+        ewma = self.ewma.get(kind)
+        self.ewma[kind] = latency if ewma is None else 0.8*ewma + 0.2*latency
+
+    def percentile(self, kind, p, min_samples):
+        latencies = sorted(self.latencies.get(kind, []))
+        if len(latencies) < min_samples:
+            return None
+        return latencies[int(p*(len(latencies)-1))]
+
+class RetryBudget:
+    # every request adds ratio to the budget and every retry or hedge takes 1,
+    # so that the extra requests are bounded to the ratio of the requests while bedrock is throttling
+    def __init__(self, ratio, max_tokens=10):
+        self.ratio = ratio
+        self.max_tokens = max_tokens
+        self.tokens = max_tokens
+        self.lock = threading.Lock()
+
+    def deposit(self):
+        with self.lock:
+            self.tokens = min(self.max_tokens, self.tokens + self.ratio)
+
+    def withdraw(self):
+        with self.lock:
+            if self.tokens >= 1:
+                self.tokens = self.tokens - 1
+                return True
+            return False
+
+class ChatPool:
+    # sends a request to the endpoint with the lowest latency whose circuit is not open, fails over to the next one
+    # for the retryable errors, and optionally sends a hedged request to the next endpoint after the p95 latency.
+    def __init__(self, endpoints, max_attempts=3, retry_ratio=0.2, hedge=False, hedge_min_samples=20, on_event=None):
+        self.endpoints = endpoints
+        self.max_attempts = max_attempts
+        self.budget = RetryBudget(retry_ratio)
+        self.hedge = hedge
+        self.hedge_min_samples = hedge_min_samples
+        self.on_event = on_event  # called with the name of the retry and hedge events
+        self.executor = ThreadPoolExecutor(max_workers=32)  # the threads are created on demand
+        self.local = threading.local()  # the endpoint which answered the last request of the thread
+
+    def select(self, kind, exclude):
+        candidates = [endpoint for endpoint in self.endpoints if endpoint not in exclude and endpoint.breaker.available()]
+        if not candidates:
+            return None
+        # the endpoints without samples are used in the configured order after the measured ones
+        def latency(endpoint):
+            ewma = endpoint.ewma.get(kind)
+            return (ewma is None, ewma or 0, self.endpoints.index(endpoint))
+        return min(candidates, key=latency)
+
+    def event(self, name):
+        if self.on_event is not None:
+            self.on_event(name)
+
+    def served(self):
+        return getattr(self.local, 'endpoint', None)
+
+    def call(self, endpoint, kind, request):
+        if not endpoint.breaker.allow():
+            raise CircuitOpenError(f"circuit of {endpoint.name} is open")
+        start = time.time()
+        try:
+            result = request(endpoint)
+        except Exception as error:
+            if is_retryable(error):
+                endpoint.breaker.failure()
+            else:
+                endpoint.breaker.success()  # the endpoint answered
+            raise
+        endpoint.observe(kind, time.time() - start)
+        endpoint.breaker.success()
+        return result
+
+    def run(self, kind, request, discard=None):
+        # request(endpoint) sends the request and returns its result, discard(result) releases the result of a hedged request which lost.
+        # The latency of the kind of the call decides the endpoint and the delay of the hedged request.
+        self.budget.deposit()
+        tried = []
+        error = None
+        while len(tried) < self.max_attempts:
+            endpoint = self.select(kind, tried)
+            if endpoint is None:
+                break
+            if tried:
+                if not self.budget.withdraw():
+                    logger.warning('retry budget is exhausted', endpoint=endpoint.name)
+                    break
+                self.event('BedrockRetries')
+            tried.append(endpoint)
+            futures = {self.executor.submit(self.call, endpoint, kind, request): endpoint}
+
+            delay = endpoint.percentile(kind, 0.95, self.hedge_min_samples) if self.hedge else None
+            if delay is not None:
+                done, pending = wait(futures, timeout=delay)
+                second = self.select(kind, tried) if not done else None
+                if second is not None and self.budget.withdraw():
+                    logger.info('hedged request', endpoint=second.name, delay=round(delay, 3))
+                    self.event('BedrockHedges')
+                    tried.append(second)
+                    futures[self.executor.submit(self.call, second, kind, request)] = second
+
+            while futures:
+                done, pending = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    winner = futures.pop(future)
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        error = e
+                        logger.warning('request failed', endpoint=winner.name, error=str(e))
+                        if not is_retryable(e) and not futures:
+                            raise
+                        continue
+
+                    if winner is not endpoint:
+                        self.event('BedrockHedgesWon')
+                    if discard is not None:  # the slower request is not cancelled by boto3, its result is released when it is done
+                        def release(future):
+                            if future.exception() is None:
+                                discard(future.result())
+                        for future in futures:
+                            future.add_done_callback(release)
+                    self.local.endpoint = winner
+                    return result
+
+        raise error or Exception("No bedrock endpoint is available")
+
+    def invoke(self, messages):
+        return self.run('invoke', lambda endpoint: endpoint.chat.invoke(messages))
+
+    def stream(self, messages):
+        # the time to the first chunk decides the endpoint, a stream which failed after that can not be retried
+        def request(endpoint):
+            stream = iter(endpoint.chat.stream(messages))
+            try:
+                first = next(stream)
+            except StopIteration:
+                first = None
+            return first, stream
+
+        def discard(result):
+            close = getattr(result[1], 'close', None)
+            if close is not None:
+                close()
+
+        first, stream = self.run('stream', request, discard)
+        if first is not None:
+            yield first
+            yield from stream
+
+    def stats(self):
+        return [{'name': endpoint.name, 'state': endpoint.breaker.state, 'ewma': {kind: round(ewma, 3) for kind, ewma in endpoint.ewma.items()}} for endpoint in self.endpoints]
@@ -0,0 +1,137 @@
+import os
+import time
+import random
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+
+os.environ.setdefault('log_level', 'ERROR')
+
+from bedrock_pool import ChatPool, Endpoint, CircuitBreaker
+from langchain_core.messages import AIMessage
+
+# Tail latency of the bedrock calls against a local fake bedrock which injects throttling and slow responses.
+# The times are scaled down, about 1/20 of the real latency.
+OUTAGE = (0.5, 1.5)  # the primary region throttles every request for a second
+THROTTLE_ERROR = "Error raised by bedrock service: An error occurred (ThrottlingException) when calling the InvokeModel operation: Too many requests, please wait before trying again."
+
+class FakeBedrock:
+    # a chat model with the latency of lognormal distribution, slow responses and throttling.
+    # Every request is throttled during the outage (seconds from the start). retries emulates the retries of boto3 with exponential backoff in the client.
+    def __init__(self, latency, throttle_rate, slow_rate=0.05, outage=None, retries=0, backoff=0.05, max_backoff=1.0):
+        self.latency = latency
+        self.throttle_rate = throttle_rate
+        self.outage = outage
+        self.started = time.time()
+        self.slow_rate = slow_rate
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.calls = 0
+        self.lock = threading.Lock()
+
+    def request(self):
+        with self.lock:
+            self.calls = self.calls + 1
+            elapsed = time.time() - self.started
+            throttled = random.random() < self.throttle_rate or (self.outage is not None and self.outage[0] <= elapsed < self.outage[1])
+            slow = random.random() < self.slow_rate
+            latency = self.latency*random.lognormvariate(0, 0.4)*(8 if slow else 1)
+        if throttled:
+            time.sleep(self.latency*0.1)
+            raise ValueError(THROTTLE_ERROR)
+        time.sleep(latency)
+
+    def invoke(self, messages):
+        for attempt in range(self.retries+1):
+            try:
+                self.request()
+                return AIMessage(content="answer")
+            except ValueError:
+                if attempt == self.retries:
+                    raise
+                delay = min(self.max_backoff, self.backoff*(2**attempt))
+                time.sleep(random.uniform(0, delay))
+
+def run(name, pool, fakes, n=400, concurrency=8):
+    latencies = []
+    failures = 0
+    lock = threading.Lock()
+
+    def request(i):
+        nonlocal failures
+        start = time.time()
+        try:
+            pool.invoke("question")
+            ok = True
+        except Exception:
+            ok = False
+        with lock:
+            if ok:
+                latencies.append(time.time()-start)
+            else:
+                failures = failures + 1
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(request, range(n)))
+
+    latencies.sort()
+    def percentile(p):
+        return latencies[int(p*(len(latencies)-1))]*1000
+    calls = sum(fake.calls for fake in fakes)
+    print(f"{name}: p50 {percentile(0.5):.0f}ms, p95 {percentile(0.95):.0f}ms, p99 {percentile(0.99):.0f}ms, max {latencies[-1]*1000:.0f}ms, failures {failures}/{n}, bedrock calls per request {calls/n:.2f}")
+
+class TimedChat:
+    # the first chunk of a stream comes after first seconds, a whole answer after total seconds
+    def __init__(self, first, total):
+        self.first = first
+        self.total = total
+
+    def invoke(self, messages):
+        time.sleep(self.total)
+        return AIMessage(content="answer")
+
+    def stream(self, messages):
+        time.sleep(self.first)
+        yield AIMessage(content="an")
+        time.sleep(self.total - self.first)
+        yield AIMessage(content="swer")
+
+def check_kinds():
+    # the whole answers of the invokes do not lift the hedge delay of the streams, which is the time to the first chunk
+    endpoint = Endpoint('us-west-2', TimedChat(0.001, 0.02), CircuitBreaker(5, 1.0))
+    pool = ChatPool([endpoint], hedge=True, hedge_min_samples=5)
+    for i in range(10):
+        pool.invoke("question")
+        list(pool.stream("question"))
+    stream = endpoint.percentile('stream', 0.95, 5)
+    invoke = endpoint.percentile('invoke', 0.95, 5)
+    assert stream < invoke/2, f"the p95 of the streams {stream*1000:.0f}ms is not below the invokes {invoke*1000:.0f}ms"
+    assert pool.served() is endpoint
+    print(f"kinds: p95 of the first chunk {stream*1000:.1f}ms, of the invoke {invoke*1000:.1f}ms")
+
+def main():
+    random.seed(1)
+    check_kinds()
+
+    # before: one region and up to 30 attempts with backoff in boto3
+    primary = FakeBedrock(latency=0.05, throttle_rate=0.1, outage=OUTAGE, retries=29)
+    pool = ChatPool([Endpoint('us-west-2', primary, CircuitBreaker(5, 1.0))], max_attempts=1)
+    run('single region, 30 attempts', pool, [primary])
+
+    # after: 3 attempts in a region, failover to the second region with circuit breakers and the retry budget
+    primary = FakeBedrock(latency=0.05, throttle_rate=0.1, outage=OUTAGE, retries=2)
+    secondary = FakeBedrock(latency=0.065, throttle_rate=0.02, retries=2)
+    endpoints = [Endpoint('us-west-2', primary, CircuitBreaker(5, 1.0)), Endpoint('us-east-1', secondary, CircuitBreaker(5, 1.0))]
+    pool = ChatPool(endpoints, max_attempts=3, retry_ratio=0.2)
+    run('two regions, failover', pool, [primary, secondary])
+
+    # after: and a hedged request after the p95 latency
+    primary = FakeBedrock(latency=0.05, throttle_rate=0.1, outage=OUTAGE, retries=2)
+    secondary = FakeBedrock(latency=0.065, throttle_rate=0.02, retries=2)
+    endpoints = [Endpoint('us-west-2', primary, CircuitBreaker(5, 1.0)), Endpoint('us-east-1', secondary, CircuitBreaker(5, 1.0))]
+    pool = ChatPool(endpoints, max_attempts=3, retry_ratio=0.2, hedge=True)
+    run('two regions, failover and hedging', pool, [primary, secondary])
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+import os
+import time
+import boto3
+
+from botocore.config import Config
+from botocore.stub import Stubber
+
+# the stubbed calls are signed, so dummy credentials are enough
+os.environ.setdefault('AWS_ACCESS_KEY_ID', 'testing')
+os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'testing')
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-west-2')
+
+from aws_clients import get_client
+
+ITEM = {
+    'user_id': {'S':'user1234'},
+    'request_id': {'S':'test1234'},
+    'request_time': {'S':'2023-10-08 18:01:45'},
+    'type': {'S':'text'},
+    'body': {'S':'Building a website can be done in 10 simple steps.'},
+    'msg': {'S':'answer'}
+}
+
+def put_item(client):
+    client.put_item(TableName='callLog', Item=ITEM)
+
+def per_call_client(n):
+    # before: a new client is created for every request
+    start = time.time()
+    for i in range(n):
+        client = boto3.client('dynamodb')
+        with Stubber(client) as stubber:
+            stubber.add_response('put_item', {})
+            put_item(client)
+    return (time.time()-start)/n
+
+def pooled_client(n):
+    # after: the client is created once per container
+    client = get_client('dynamodb')
+    stubber = Stubber(client)
+    stubber.activate()
+    start = time.time()
+    for i in range(n):
+        stubber.add_response('put_item', {})
+        put_item(get_client('dynamodb'))
+    stubber.deactivate()
+    return (time.time()-start)/n
+
+def check_config():
+    # the client of a config of its own is not the one of the default config, whichever is created first
+    default = get_client('bedrock-runtime', region_name='us-west-2')
+    adaptive = get_client('bedrock-runtime', region_name='us-west-2', config=Config(retries={'max_attempts': 5, 'mode': 'adaptive'}))
+    assert adaptive is not default
+    assert adaptive is get_client('bedrock-runtime', region_name='us-west-2', config=Config(retries={'max_attempts': 5, 'mode': 'adaptive'}))
+    assert adaptive.meta.config.retries['total_max_attempts'] == 6, adaptive.meta.config.retries  # the first attempt and 5 retries
+    print("config: the clients of different configs are kept apart")
+
+def main():
+    check_config()
+
+    n = 200
+    before = per_call_client(n)
+    after = pooled_client(n)
+
+    print('per-call client: %0.3fms per request' % (before*1000))
+    print('pooled client: %0.3fms per request' % (after*1000))
+    print('speedup: %0.1fx' % (before/after))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,358 @@
+import io
+import os
+import sys
+import json
+import time
+import random
+import threading
+
+from contextlib import redirect_stdout
+from botocore.exceptions import ClientError
+
+os.environ.setdefault('AWS_ACCESS_KEY_ID', 'testing')
+os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'testing')
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-west-2')
+os.environ.setdefault('s3_prefix', 'docs')
+os.environ.setdefault('callLogTableName', 'callLog')
+os.environ.setdefault('connection_url', 'https://websocket.local/dev')
+os.environ.setdefault('log_level', 'ERROR')
+
+import aws_clients
+import lambda_function
+from bedrock_pool import ChatPool, Endpoint, CircuitBreaker
+from langchain_core.messages import AIMessage, AIMessageChunk
+
+# Replays websocket events of several users through lambda_handler with local stand-ins for bedrock, the websocket
+# api and dynamodb, and reports what a user sees: the time to the first text, the rate of the streamed tokens,
+# the messages and the bytes per answer and the latency of the handler. The overhead is the handler latency
+# minus the time of the fake model, and fails the run when it is over the budget, so run it before deploying.
+# python bench_handler.py, the settings are the environment variables below.
+
+requests_count = int(os.environ.get('bench_requests', '100'))
+users = int(os.environ.get('bench_users', '10'))
+token_rate = float(os.environ.get('bench_token_rate', '400'))  # tokens/s of the fake model
+first_token_latency = float(os.environ.get('bench_first_token_latency', '0.2'))  # seconds
+answer_tokens = int(os.environ.get('bench_answer_tokens', '120'))  # mean tokens of an answer
+send_latency = float(os.environ.get('bench_send_latency', '0.01'))  # seconds of post_to_connection
+dynamodb_latency = float(os.environ.get('bench_dynamodb_latency', '0.005'))
+repeat_rate = float(os.environ.get('bench_repeat_rate', '0.1'))  # questions which were asked before, for the response cache
+overhead_budget_ms = float(os.environ.get('bench_overhead_budget_ms', '150'))  # p99 of the handler overhead
+ttft_budget_ms = float(os.environ.get('bench_ttft_budget_ms', '100'))  # p99 of the time to the first text after the first token
+
+# the share of the conversation types, and of the pings which keep the connection alive
+MIX = {
+    'normal': 0.45,
+    'translation': 0.15,
+    'grammar': 0.08,
+    'sentiment': 0.05,
+    'extraction': 0.05,
+    'pii': 0.05,
+    'step-by-step': 0.07,
+    'timestamp-extraction': 0.05,
+    '__ping__': 0.05
+}
+KOREAN_RATE = 0.3
+
+WORDS = "the a website can be built in ten simple steps with hosting domain design content and testing before launch please tell me how".split()
+HANGUL = "웹사이트는 열 가지 단계로 간단하게 만들 수 있습니다 호스팅 도메인 디자인 콘텐츠 테스트 알려주세요".split()
+
+class FakeBedrock:
+    # stands in for ChatBedrock: the answer comes after first_token_latency, and then a token at every 1/token_rate.
+    # The answer is in <result> tags when the prompt asks for them, with a sentence before it as the models do.
+    def __init__(self, token_rate, first_token_latency, answer_tokens):
+        self.token_rate = token_rate
+        self.first_token_latency = first_token_latency
+        self.answer_tokens = answer_tokens
+        self.busy = 0.0  # seconds which the model took, to separate the handler overhead
+        self.lock = threading.Lock()
+
+    def answer(self, messages):
+        prompt = messages.to_string() if hasattr(messages, 'to_string') else str(messages)
+        n = max(1, int(random.expovariate(1/self.answer_tokens)))
+        tokens = [f" {random.choice(WORDS)}" for i in range(n)]
+        if '<result>' in prompt:
+            tokens = ["Here is the result.", "\n<result>\n"] + tokens + ["\n</result>"]
+        return tokens, lambda_function.estimate_tokens(prompt)
+
+    def wait(self, seconds):
+        start = time.time()
+        time.sleep(seconds)
+        with self.lock:
+            self.busy = self.busy + time.time() - start  # sleep oversleeps, which is not the overhead of the handler
+
+    def stream(self, messages):
+        tokens, input_tokens = self.answer(messages)
+        self.wait(self.first_token_latency)
+        for i, token in enumerate(tokens):
+            if i:
+                self.wait(1/self.token_rate)
+            yield AIMessageChunk(content=token)
+        yield AIMessageChunk(content="", usage_metadata={'input_tokens': input_tokens, 'output_tokens': len(tokens), 'total_tokens': input_tokens+len(tokens)})
+
+    def invoke(self, messages):
+        tokens, input_tokens = self.answer(messages)
+        self.wait(self.first_token_latency + (len(tokens)-1)/self.token_rate)
+        return AIMessage(content="".join(tokens), usage_metadata={'input_tokens': input_tokens, 'output_tokens': len(tokens), 'total_tokens': input_tokens+len(tokens)})
+
+class FakeApiGateway:
+    # records the messages to the connections with their time
+    def __init__(self, latency):
+        self.latency = latency
+        self.calls = []  # (time, connection id, data)
+        self.lock = threading.Lock()
+
+    def post_to_connection(self, ConnectionId, Data):
+        time.sleep(self.latency)
+        with self.lock:
+            self.calls.append((time.time(), ConnectionId, Data))
+        return {}
+
+OPERATORS = {
+    '=': lambda a, b: a == b,
+    '<': lambda a, b: a < b,
+    '<=': lambda a, b: a <= b,
+    '>': lambda a, b: a > b,
+    '>=': lambda a, b: a >= b
+}
+
+def attribute_value(value):
+    return float(value['N']) if 'N' in value else value.get('S')
+
+class FakeDynamoDB:
+    # an in-memory dynamodb for the calls of the call log, the response cache and the request registry. The items are
+    # kept in the attribute value format. The conditions are comparisons and attribute_(not_)exists which are joined
+    # by AND and OR without parentheses, and the updates SET and REMOVE attributes and ADD to string sets.
+    def __init__(self, keys, latency):
+        self.keys = keys  # table name: (partition key, sort key or None)
+        self.latency = latency
+        self.tables = dict()
+        self.lock = threading.Lock()
+
+    def key(self, table_name, item):
+        return tuple(item[name]['S'] for name in self.keys[table_name] if name)
+
+    def check(self, operation, item, ConditionExpression=None, ExpressionAttributeNames={}, ExpressionAttributeValues={}, **kwargs):
+        if ConditionExpression is None:
+            return
+        def term(condition):
+            if condition.startswith('attribute_not_exists('):
+                return ExpressionAttributeNames.get(condition[21:-1], condition[21:-1]) not in item
+            if condition.startswith('attribute_exists('):
+                return ExpressionAttributeNames.get(condition[17:-1], condition[17:-1]) in item
+            name, operator, value = condition.split()
+            name = ExpressionAttributeNames.get(name, name)
+            return name in item and OPERATORS[operator](attribute_value(item[name]), attribute_value(ExpressionAttributeValues[value]))
+        # AND binds tighter than OR as in dynamodb
+        if not any(all(term(condition) for condition in conjunction.split(' AND ')) for conjunction in ConditionExpression.split(' OR ')):
+            raise ClientError({'Error': {'Code': 'ConditionalCheckFailedException', 'Message': 'The conditional request failed'}}, operation)
+
+    def put_item(self, TableName, Item, ReturnValues='NONE', **kwargs):
+        time.sleep(self.latency)
+        with self.lock:
+            table = self.tables.setdefault(TableName, dict())
+            old = table.get(self.key(TableName, Item))
+            self.check('PutItem', old or {}, **kwargs)
+            table[self.key(TableName, Item)] = Item
+        return {'Attributes': old} if ReturnValues == 'ALL_OLD' and old else {}
+
+    def update_item(self, TableName, Key, UpdateExpression, ExpressionAttributeValues, ExpressionAttributeNames={}, ReturnValues='NONE', **kwargs):
+        time.sleep(self.latency)
+        with self.lock:
+            table = self.tables.setdefault(TableName, dict())
+            old = table.get(self.key(TableName, Key))
+            self.check('UpdateItem', old or {}, ExpressionAttributeNames=ExpressionAttributeNames, ExpressionAttributeValues=ExpressionAttributeValues, **kwargs)
+            item = dict(old or Key)
+            action = None
+            for word in UpdateExpression.replace(',', ' ').split():
+                if word in ['SET', 'REMOVE', 'ADD']:
+                    action = word
+                    continue
+                if action == 'SET' and word != '=':
+                    if word.startswith(':'):
+                        item[name] = ExpressionAttributeValues[word]
+                    else:
+                        name = ExpressionAttributeNames.get(word, word)
+                elif action == 'REMOVE':
+                    item.pop(ExpressionAttributeNames.get(word, word), None)
+                elif action == 'ADD':  # string sets
+                    if word.startswith(':'):
+                        item[name] = {'SS': sorted(set(item.get(name, {}).get('SS', [])) | set(ExpressionAttributeValues[word]['SS']))}
+                    else:
+                        name = ExpressionAttributeNames.get(word, word)
+            table[self.key(TableName, Key)] = item
+        return {'Attributes': old} if ReturnValues == 'ALL_OLD' and old else {}
+
+    def delete_item(self, TableName, Key, ReturnValues='NONE', **kwargs):
+        time.sleep(self.latency)
+        with self.lock:
+            table = self.tables.setdefault(TableName, dict())
+            old = table.get(self.key(TableName, Key))
+            self.check('DeleteItem', old or {}, **kwargs)
+            table.pop(self.key(TableName, Key), None)
+        return {'Attributes': old} if ReturnValues == 'ALL_OLD' and old else {}
+
+    def batch_write_item(self, RequestItems, **kwargs):
+        time.sleep(self.latency)
+        with self.lock:
+            for table_name, requests in RequestItems.items():
+                for request in requests:
+                    item = request['PutRequest']['Item']
+                    self.tables.setdefault(table_name, dict())[self.key(table_name, item)] = item
+        return {'UnprocessedItems': {}}
+
+    def get_item(self, TableName, Key, **kwargs):
+        time.sleep(self.latency)
+        item = self.tables.get(TableName, {}).get(self.key(TableName, Key))
+        return {'Item': item} if item is not None else {}
+
+    def query(self, TableName, KeyConditionExpression, ExpressionAttributeValues, ScanIndexForward=True, Limit=None, ExclusiveStartKey=None, **kwargs):
+        time.sleep(self.latency)
+        conditions = []
+        for condition in KeyConditionExpression.split(' AND '):
+            name, operator, value = condition.split()
+            conditions.append((name, operator, ExpressionAttributeValues[value]['S']))
+        with self.lock:
+            items = [item for item in self.tables.get(TableName, {}).values() if all(name in item and OPERATORS[operator](item[name]['S'], value) for name, operator, value in conditions)]
+
+        sort_key = self.keys[TableName][1]
+        items.sort(key=lambda item: item[sort_key]['S'], reverse=not ScanIndexForward)
+        if ExclusiveStartKey is not None:
+            start = [self.key(TableName, item) for item in items].index(self.key(TableName, ExclusiveStartKey)) + 1
+            items = items[start:]
+
+        response = {'Count': 0, 'ConsumedCapacity': {'TableName': TableName, 'CapacityUnits': 0.5}}
+        if Limit is not None and len(items) > Limit:
+            items = items[:Limit]
+            response['LastEvaluatedKey'] = {name: items[-1][name] for name in self.keys[TableName] if name}
+        response['Items'] = items
+        response['Count'] = len(items)
+        return response
+
+def install(bedrock, api, dynamodb):
+    # the clients are looked up by aws_clients.get_client, so the stand-ins are put in its cache
+    aws_clients.clients[('dynamodb', None, None)] = dynamodb
+    aws_clients.clients[('apigatewaymanagementapi', None, lambda_function.connection_url)] = api
+    lambda_function.chat = ChatPool([Endpoint('fake', bedrock, CircuitBreaker(5, 30))], on_event=lambda_function.trace.count)
+
+def question(korean):
+    words = HANGUL if korean else WORDS
+    return " ".join(random.choice(words) for i in range(random.randint(5, 40)))
+
+def make_events(n, users):
+    # the users talk at the same time, so their requests are interleaved
+    events = []
+    asked = []
+    clock = time.mktime((2024, 1, 1, 9, 0, 0, 0, 0, -1))
+    for user in range(users):
+        events.append({'requestContext': {'connectionId': f"connection-{user}", 'routeKey': '$connect'}})
+    for i in range(n):
+        user = random.randrange(users)
+        convType = random.choices(list(MIX), weights=list(MIX.values()))[0]
+        context = {'connectionId': f"connection-{user}", 'routeKey': '$default'}
+        if convType == '__ping__':
+            events.append({'requestContext': context, 'body': '__ping__'})
+            continue
+
+        if asked and random.random() < repeat_rate:
+            convType, text = random.choice(asked)
+        else:
+            text = question(random.random() < KOREAN_RATE)
+            asked.append((convType, text))
+        clock = clock + random.uniform(1, 30)
+        body = {
+            'user_id': f"user-{user}",
+            'request_id': f"request-{i}",
+            'request_time': time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(clock)),
+            'type': 'text',
+            'body': text,
+            'convType': convType
+        }
+        events.append({'requestContext': context, 'body': json.dumps(body)})
+    for user in range(users):
+        events.append({'requestContext': {'connectionId': f"connection-{user}", 'routeKey': '$disconnect'}})
+    return events
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[int(p*(len(values)-1))] if values else 0.0
+
+def replay(events, bedrock, api):
+    results = []
+    for event in events:
+        calls = len(api.calls)
+        busy = bedrock.busy
+        start = time.time()
+        with redirect_stdout(io.StringIO()):  # the metric lines of the trace
+            lambda_function.lambda_handler(event, None)
+        end = time.time()
+        if event['requestContext']['routeKey'] != '$default' or event['body'] == '__ping__':
+            continue
+
+        body = json.loads(event['body'])
+        messages = [(sent, json.loads(data)) for sent, connection, data in api.calls[calls:]]
+        texts = [sent for sent, message in messages if message['status'] in ['delta', 'proceeding', 'completed']]
+        deltas = [sent for sent, message in messages if message['status'] in ['delta', 'proceeding']]
+        tokens = lambda_function.trace.metrics.get('OutputTokens', [0])[0]
+        results.append({
+            'convType': body['convType'],
+            'latency': end - start,
+            'overhead': end - start - (bedrock.busy - busy),
+            'ttft': texts[0] - start if texts else None,
+            'ttft_overhead': texts[0] - start - first_token_latency if texts and tokens else None,
+            'tokens_per_second': tokens/(deltas[-1] - deltas[0]) if len(deltas) > 1 else None,
+            'sends': len(messages),
+            'bytes': sum(len(data) for sent, connection, data in api.calls[calls:]),
+            'cached': not tokens,
+            'cold': not results  # the first request imports langchain and builds the prompt and the memory
+        })
+    return results
+
+def report(name, results):
+    def values(key):
+        return [result[key] for result in results if result[key] is not None]
+    print(f"{name:<22}{len(results):>5}{percentile(values('ttft'), 0.5)*1000:>10.0f}{percentile(values('ttft'), 0.99)*1000:>10.0f}"
+          f"{percentile(values('tokens_per_second'), 0.5):>10.0f}{sum(values('sends'))/len(results):>8.1f}{sum(values('bytes'))/len(results):>9.0f}"
+          f"{percentile(values('latency'), 0.5)*1000:>10.0f}{percentile(values('latency'), 0.99)*1000:>10.0f}{percentile(values('overhead'), 0.99)*1000:>10.0f}")
+
+def main():
+    random.seed(1)
+    bedrock = FakeBedrock(token_rate, first_token_latency, answer_tokens)
+    api = FakeApiGateway(send_latency)
+    dynamodb = FakeDynamoDB({lambda_function.callLogTableName: ('user_id', 'request_time')}, dynamodb_latency)
+    install(bedrock, api, dynamodb)
+
+    events = make_events(requests_count, users)
+    print(f"model: {token_rate:.0f} tokens/s, first token {first_token_latency*1000:.0f}ms, {answer_tokens} tokens per answer; send {send_latency*1000:.0f}ms, dynamodb {dynamodb_latency*1000:.0f}ms")
+    print(f"stream: {lambda_function.stream_mode}, sender {lambda_function.stream_sender}, flush {lambda_function.stream_flush_bytes} bytes or {lambda_function.stream_flush_interval*1000:.0f}ms; memory: {lambda_function.memory_mode}")
+
+    start = time.time()
+    results = replay(events, bedrock, api)
+    elapsed = time.time() - start
+    cold = results.pop(0)
+
+    print(f"{'convType':<22}{'n':>5}{'ttft p50':>10}{'ttft p99':>10}{'tokens/s':>10}{'sends':>8}{'bytes':>9}{'lat p50':>10}{'lat p99':>10}{'ovh p99':>10}")
+    for convType in MIX:
+        selected = [result for result in results if result['convType'] == convType]
+        if selected:
+            report(convType, selected)
+    report('all', results)
+    cached = sum(1 for result in results if result['cached'])
+    print(f"first request (cold, not in the table): latency {cold['latency']*1000:.0f}ms, overhead {cold['overhead']*1000:.0f}ms")
+    print(f"{len(events)} events in {elapsed:.1f}s, {len(results)/elapsed:.1f} requests/s, cached answers {cached}, call log items {len(dynamodb.tables.get(lambda_function.callLogTableName, {}))}")
+
+    failed = False
+    overhead = percentile([result['overhead'] for result in results], 0.99)*1000
+    if overhead > overhead_budget_ms:
+        print(f"FAIL: p99 overhead of the handler is {overhead:.0f}ms which is over the budget of {overhead_budget_ms:.0f}ms")
+        failed = True
+    ttft = percentile([result['ttft_overhead'] for result in results if result['ttft_overhead'] is not None], 0.99)*1000
+    if ttft > ttft_budget_ms:
+        print(f"FAIL: p99 of the time to the first text after the first token is {ttft:.0f}ms which is over the budget of {ttft_budget_ms:.0f}ms")
+        failed = True
+
+    if failed:
+        sys.exit(1)
+    print('OK')
+
+if __name__ == '__main__':
+    main()
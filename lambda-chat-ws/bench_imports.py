@@ -0,0 +1,83 @@
+import os
+import sys
+import json
+import subprocess
+
+# Profiles the cold start of lambda_function with "python -X importtime" and fails when the packages
+# which have to be imported lazily are loaded at the module level or the import takes longer than the budget.
+# In the image: docker run --rm --entrypoint /var/lang/bin/python3 <image> /var/task/bench_imports.py
+
+LAZY_MODULES = ['langchain', 'langchain_core', 'langchain_aws', 'langchain_community', 'langchain_text_splitters', 'PyPDF2', 'docx', 'pptx', 'multiprocessing', 'numpy']
+import_budget_ms = float(os.environ.get('import_budget_ms', '500'))
+RUNS = 5
+
+env = dict(os.environ)
+env.setdefault('AWS_ACCESS_KEY_ID', 'testing')
+env.setdefault('AWS_SECRET_ACCESS_KEY', 'testing')
+env.setdefault('AWS_DEFAULT_REGION', 'us-west-2')
+env.setdefault('s3_prefix', 'docs')
+env.setdefault('callLogTableName', 'callLog')
+
+directory = os.path.dirname(os.path.abspath(__file__))
+
+# the time of the import and of the first chat request which builds the chat model, the prompt and the memory
+PROBE = """
+import sys, time, json
+start = time.perf_counter()
+import lambda_function
+imported = time.perf_counter()
+lambda_function.get_prompt('normal', 'en')
+lambda_function.get_chat()
+from langchain.memory import ConversationBufferWindowMemory
+first_request = time.perf_counter()
+print(json.dumps({'import': imported-start, 'first_request': first_request-imported, 'modules': list(sys.modules)}))
+"""
+
+def run_probe():
+    result = subprocess.run([sys.executable, '-c', PROBE], cwd=directory, env=env, capture_output=True, text=True, check=True)
+    return json.loads(result.stdout.strip().split('\n')[-1])
+
+def import_profile():
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import lambda_function'], cwd=directory, env=env, capture_output=True, text=True, check=True)
+
+    profile = dict()  # top level package: self time in us
+    for line in result.stderr.split('\n'):
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        self_time, cumulative, name = line[len('import time:'):].split('|')
+        package = name.strip().split('.')[0]
+        profile[package] = profile.get(package, 0) + int(self_time)
+    return profile
+
+def median(values):
+    values = sorted(values)
+    return values[len(values)//2]
+
+def main():
+    profile = import_profile()
+    print('import time by package (ms):')
+    for package, self_time in sorted(profile.items(), key=lambda item: item[1], reverse=True)[:15]:
+        print(f"  {package}: {self_time/1000:.1f}")
+
+    probes = [run_probe() for i in range(RUNS)]
+    import_time = median([probe['import'] for probe in probes])*1000
+    first_request = median([probe['first_request'] for probe in probes])*1000
+    print(f"import lambda_function: {import_time:.1f}ms, first chat request setup: {first_request:.1f}ms (median of {RUNS})")
+
+    failed = False
+    loaded = sorted(set(module.split('.')[0] for module in probes[0]['modules']) & set(LAZY_MODULES))
+    profiled = sorted(set(profile) & set(LAZY_MODULES))
+    if profiled:
+        print(f"FAIL: imported at the module level: {profiled}")
+        failed = True
+    if import_time > import_budget_ms:
+        print(f"FAIL: import takes {import_time:.1f}ms which is over the budget of {import_budget_ms:.0f}ms")
+        failed = True
+    print(f"loaded by the first chat request: {loaded}")
+
+    if failed:
+        sys.exit(1)
+    print('OK')
+
+if __name__ == '__main__':
+    main()
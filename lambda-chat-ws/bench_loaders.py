@@ -0,0 +1,130 @@
+import io
+import os
+import json
+import time
+
+os.environ.setdefault('AWS_ACCESS_KEY_ID', 'testing')
+os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'testing')
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-west-2')
+os.environ.setdefault('s3_bucket', 'bucket')
+os.environ.setdefault('s3_prefix', 'docs')
+
+import aws_clients
+from botocore.response import StreamingBody
+
+SENTENCE = "Amazon Bedrock is a fully managed service that offers a choice of foundation models. "
+
+class StubS3:
+    # serves the sample files from the memory instead of s3
+    def __init__(self):
+        self.objects = dict()
+
+    def get_object(self, Bucket, Key):
+        data = self.objects[Key]
+        return {
+            'Body': StreamingBody(io.BytesIO(data), len(data)),
+            'ContentLength': len(data)
+        }
+
+def make_pdf(pages):
+    # a minimal pdf with one line of text per page
+    objects = ["<< /Type /Catalog /Pages 2 0 R >>", None, "<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"]
+    kids = []
+    for i in range(pages):
+        text = f"BT /F1 10 Tf 50 750 Td (Page {i+1}. {SENTENCE*5}) Tj ET"
+        objects.append(f"<< /Length {len(text)} >>\nstream\n{text}\nendstream")
+        objects.append(f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] /Resources << /Font << /F1 3 0 R >> >> /Contents {len(objects)} 0 R >>")
+        kids.append(f"{len(objects)} 0 R")
+    objects[1] = f"<< /Type /Pages /Kids [{' '.join(kids)}] /Count {pages} >>"
+
+    out = io.BytesIO()
+    out.write(b"%PDF-1.4\n")
+    offsets = []
+    for i, obj in enumerate(objects):
+        offsets.append(out.tell())
+        out.write(f"{i+1} 0 obj\n{obj}\nendobj\n".encode('latin-1'))
+    xref = out.tell()
+    out.write(f"xref\n0 {len(objects)+1}\n0000000000 65535 f \n".encode('latin-1'))
+    for offset in offsets:
+        out.write(f"{offset:010d} 00000 n \n".encode('latin-1'))
+    out.write(f"trailer\n<< /Size {len(objects)+1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n".encode('latin-1'))
+    return out.getvalue()
+
+def make_docx(paragraphs):
+    import docx
+    document = docx.Document()
+    for i in range(paragraphs):
+        document.add_paragraph(SENTENCE*3)
+    out = io.BytesIO()
+    document.save(out)
+    return out.getvalue()
+
+def make_pptx(slides):
+    from pptx import Presentation
+    from pptx.util import Inches
+    presentation = Presentation()
+    for i in range(slides):
+        slide = presentation.slides.add_slide(presentation.slide_layouts[5])
+        slide.shapes.title.text = f"Slide {i+1}"
+        slide.shapes.add_textbox(Inches(1), Inches(2), Inches(8), Inches(4)).text_frame.text = SENTENCE*5
+    out = io.BytesIO()
+    presentation.save(out)
+    return out.getvalue()
+
+def make_samples():
+    lines = [f"{i}: {SENTENCE}" for i in range(20000)]
+    return {
+        'pdf': make_pdf(300),
+        'txt': "\n".join(lines).encode('utf-8'),
+        'md': "\n".join(f"## {line}" for line in lines).encode('utf-8'),
+        'csv': ("id,name,description\n" + "\n".join(f'{i},item{i},"{SENTENCE}"' for i in range(20000))).encode('utf-8'),
+        'docx': make_docx(2000),
+        'pptx': make_pptx(200),
+        'html': ("<html><head><style>p {}</style></head><body>" + "".join(f"<p>{line}</p>" for line in lines) + "</body></html>").encode('utf-8'),
+        'json': json.dumps([{'id': i, 'text': SENTENCE} for i in range(20000)]).encode('utf-8'),
+    }
+
+def join_chunks(chunks, overlap):
+    # the chunks back into the text: each chunk starts with at most overlap characters of the previous ones
+    text = ""
+    for chunk in chunks:
+        shared = next((k for k in range(min(overlap, len(chunk), len(text)), 0, -1) if text.endswith(chunk[:k])), 0)
+        text = text + (chunk[shared:] if shared else " " + chunk)
+    return text.strip()
+
+def check_split():
+    # repeated segments, as the boilerplate and the table rows, are split once. The period of the text is longer
+    # than the overlap, so the overlap of two chunks is found without ambiguity.
+    from lambda_function import split_text_stream
+    segments = [SENTENCE*2 for i in range(2000)]
+    chunks = [text for text, metadata in split_text_stream((segment, {'paragraph': i}) for i, segment in enumerate(segments))]
+    expected = " ".join(" ".join(segments).split())
+    joined = " ".join(join_chunks(chunks, 100).split())
+    assert joined == expected, f"{len(expected)} chars are split into {len(chunks)} chunks of {len(joined)} chars"
+    print(f"split: {len(expected)} chars of repeated segments, {len(chunks)} chunks without duplicates")
+
+def main():
+    check_split()
+
+    s3 = StubS3()
+    aws_clients.clients[('s3', None, None)] = s3
+
+    from lambda_function import load_document, document_loaders
+
+    samples = make_samples()
+    for file_type in document_loaders:
+        data = samples[file_type]
+        s3.objects['docs/sample.'+file_type] = data
+
+        start = time.time()
+        chunks = 0
+        chars = 0
+        for text, metadata in load_document(file_type, 'sample.'+file_type):
+            chunks = chunks + 1
+            chars = chars + len(text)
+        elapsed = time.time() - start
+
+        print(f"{file_type}: {len(data)/1024/1024:.2f}MB, {chunks} chunks, {elapsed:.2f}s, {len(data)/1024/1024/elapsed:.2f}MB/s, {chars/elapsed/1000:.0f}K chars/s")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,209 @@
+import io
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import tempfile
+
+from contextlib import redirect_stdout
+from botocore.exceptions import ClientError
+from botocore.response import StreamingBody
+
+directory = tempfile.mkdtemp(prefix='bench-retrieval-')
+os.environ.setdefault('s3_bucket', 'bench')
+os.environ.setdefault('retrieval', 'true')
+os.environ.setdefault('embedding_model_id', 'local')
+os.environ.setdefault('retrieval_min_score', '0.05')  # the scores of the local embedding are low
+os.environ.setdefault('vector_index_prefix', 'index/')
+os.environ.setdefault('vector_index_dir', os.path.join(directory, 'vector-index'))
+os.environ.setdefault('document_cache_dir', os.path.join(directory, 'document-cache'))
+
+import numpy as np
+from bench_handler import FakeBedrock, FakeApiGateway, FakeDynamoDB, install, percentile, WORDS  # sets the environment of the handler
+import aws_clients
+import lambda_function
+from vector_index import VectorIndex, normalize
+
+# Measures the vector index of the documents: the search latency and the load time of the memory mapped files by the
+# number of chunks. Then documents of several sizes are uploaded through lambda_handler with the local embedding, and
+# the questions about them check that the retrieved chunks have the answer and that the prompt tokens stay flat while
+# the documents grow. At last a cold container loads the index of the session from the s3 stand-in.
+# python bench_retrieval.py, the settings are the environment variables below.
+
+dimension = int(os.environ.get('bench_dimension', '1024'))
+index_sizes = [int(size) for size in os.environ.get('bench_index_sizes', '1000,10000,30000').split(',')]
+queries = int(os.environ.get('bench_queries', '100'))
+document_sizes = [int(size) for size in os.environ.get('bench_document_sizes', '100,1000,3000').split(',')]  # the facts in a document
+questions = int(os.environ.get('bench_questions', '10'))  # per document
+search_budget_ms = float(os.environ.get('bench_search_budget_ms', '50'))  # p50 of a search in the largest index
+min_hit_rate = float(os.environ.get('bench_min_hit_rate', '0.8'))  # the questions whose answer is in the prompt
+flat_ratio = float(os.environ.get('bench_flat_ratio', '1.5'))  # the prompt tokens of the largest document to the second one
+# the smaller documents may have less than top k similar chunks, so the two largest ones are compared
+
+ADJECTIVES = "red green blue silver golden wooden frozen hidden ancient quiet".split()
+SYLLABLES = "ka lo mi ne su ta ri po ve da zu fi go ha je wo".split()  # the names of the items
+
+class FakeS3:
+    # the objects of the documents and the files of the vector index in the memory
+    def __init__(self):
+        self.objects = dict()  # (bucket, key): bytes
+
+    def error(self, code):
+        return ClientError({'Error': {'Code': code, 'Message': 'Not Found'}}, 'GetObject')
+
+    def head_object(self, Bucket, Key):
+        if (Bucket, Key) not in self.objects:
+            raise self.error('404')
+        data = self.objects[(Bucket, Key)]
+        return {'ContentLength': len(data), 'ETag': f'"{hash(data)}"'}
+
+    def get_object(self, Bucket, Key):
+        if (Bucket, Key) not in self.objects:
+            raise self.error('NoSuchKey')
+        data = self.objects[(Bucket, Key)]
+        return {'ContentLength': len(data), 'Body': StreamingBody(io.BytesIO(data), len(data))}
+
+    def upload_file(self, Filename, Bucket, Key):
+        with open(Filename, 'rb') as f:
+            self.objects[(Bucket, Key)] = f.read()
+
+    def download_file(self, Bucket, Key, Filename):
+        if (Bucket, Key) not in self.objects:
+            raise self.error('404')
+        with open(Filename, 'wb') as f:
+            f.write(self.objects[(Bucket, Key)])
+
+class RecordingBedrock(FakeBedrock):
+    # keeps the prompts of the streamed answers, which are the questions
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.prompts = []
+
+    def stream(self, messages):
+        self.prompts.append(messages.to_string())
+        return super().stream(messages)
+
+def measure_index():
+    print(f"{'chunks':>8}{'MB':>8}{'save ms':>10}{'load ms':>10}{'search p50':>12}{'search p99':>12}")
+    rng = np.random.default_rng(1)
+    p50 = 0.0
+    for size in index_sizes:
+        chunks = [[f"chunk {i}", {}] for i in range(size)]
+        index = VectorIndex(normalize(rng.standard_normal((size, dimension), dtype=np.float32)), chunks)
+        path = os.path.join(directory, f"index-{size}")
+
+        start = time.time()
+        index.save(path)
+        saved = time.time() - start
+        start = time.time()
+        index = VectorIndex.load(path)
+        loaded = time.time() - start
+
+        vectors = normalize(rng.standard_normal((queries, dimension), dtype=np.float32))
+        elapsed = []
+        for vector in vectors:
+            start = time.time()
+            index.search(vector, lambda_function.retrieval_top_k)
+            elapsed.append(time.time() - start)
+        p50 = percentile(elapsed, 0.5)*1000  # the first searches read the pages of the memory map
+        print(f"{size:>8}{os.path.getsize(path + '.npy')/1024/1024:>8.1f}{saved*1000:>10.1f}{loaded*1000:>10.1f}{p50:>12.2f}{percentile(elapsed, 0.99)*1000:>12.2f}")
+    return p50
+
+def make_document(n):
+    # a fact per line among the filler words, which is found by the name of its item
+    lines = []
+    facts = []
+    for i in range(n):
+        name = "".join(random.choice(SYLLABLES) for j in range(4))
+        code = f"room{random.randrange(10**6):06d}"
+        filler = " ".join(random.choice(WORDS) for j in range(20))
+        lines.append(f"The {random.choice(ADJECTIVES)} {name} is kept in {code}. {filler}")
+        facts.append((f"Which room has the {name}?", code))
+    return "\n".join(lines).encode('utf-8'), facts
+
+def send(connectionId, body):
+    with redirect_stdout(io.StringIO()):  # the metric lines of the trace
+        lambda_function.lambda_handler({'requestContext': {'connectionId': connectionId, 'routeKey': '$default'}, 'body': json.dumps(body)}, None)
+
+clock = time.time() - 24*60*60  # in the history days of the call log
+
+def request(user, type, body, convType='normal'):
+    global clock
+    clock = clock + 10
+    return {
+        'user_id': user,
+        'request_id': f"request-{clock:.0f}",
+        'request_time': time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(clock)),
+        'type': type,
+        'body': body,
+        'convType': convType
+    }
+
+def ask(bedrock, user, facts):
+    # returns the prompt tokens and the questions whose answer was in the prompt
+    tokens = []
+    hits = 0
+    for text, code in facts:
+        send(f"connection-{user}", request(user, 'text', text))
+        tokens.append(lambda_function.estimate_tokens(bedrock.prompts[-1]))
+        hits = hits + (code in bedrock.prompts[-1])
+    return tokens, hits
+
+def main():
+    random.seed(1)
+    print(f"embedding: {lambda_function.embedding_model_id}, top k {lambda_function.retrieval_top_k}, min score {lambda_function.retrieval_min_score}")
+    search_p50 = measure_index()
+
+    bedrock = RecordingBedrock(100000, 0, 20)
+    api = FakeApiGateway(0)
+    dynamodb = FakeDynamoDB({lambda_function.callLogTableName: ('user_id', 'request_time')}, 0)
+    s3 = FakeS3()
+    install(bedrock, api, dynamodb)
+    aws_clients.clients[('s3', None, None)] = s3
+
+    print(f"{'facts':>8}{'doc tokens':>12}{'index ms':>10}{'prompt tokens':>15}{'hit rate':>10}")
+    results = []
+    asked = dict()
+    for size in document_sizes:
+        user = f"user-{size}"
+        name = f"document-{size}.txt"
+        data, facts = make_document(size)
+        s3.objects[(lambda_function.s3_bucket, lambda_function.s3_prefix+'/'+name)] = data
+
+        start = time.time()
+        send(f"connection-{user}", request(user, 'document', name))
+        indexed = time.time() - start
+
+        asked[user] = random.sample(facts, min(questions, len(facts)))
+        tokens, hits = ask(bedrock, user, asked[user])
+        results.append((sum(tokens)/len(tokens), hits/len(tokens)))
+        print(f"{size:>8}{lambda_function.estimate_tokens(data.decode('utf-8')):>12}{indexed*1000:>10.0f}{results[-1][0]:>15.0f}{results[-1][1]:>10.2f}")
+
+    # a cold container: the documents of the session come from the call log and the index from s3
+    user = f"user-{document_sizes[-1]}"
+    lambda_function.vector_indexes = None
+    lambda_function.user_documents.clear()
+    lambda_function.map_chain.entries.clear()
+    start = time.time()
+    tokens, hits = ask(bedrock, user, asked[user][:1])
+    print(f"cold container: the first question in {(time.time() - start)*1000:.0f}ms, the answer is in the prompt: {bool(hits)}")
+
+    failed = False
+    if search_p50 > search_budget_ms:
+        print(f"FAIL: the search p50 {search_p50:.1f}ms is over the budget of {search_budget_ms:.0f}ms")
+        failed = True
+    if min(rate for tokens, rate in results) < min_hit_rate or not hits:
+        print(f"FAIL: the answers are not retrieved, the hit rate is under {min_hit_rate}")
+        failed = True
+    if len(results) > 1 and results[-1][0] > results[-2][0]*flat_ratio:
+        print(f"FAIL: the prompt tokens grow with the document, {results[-2][0]:.0f} to {results[-1][0]:.0f}")
+        failed = True
+    shutil.rmtree(directory, ignore_errors=True)
+    if failed:
+        sys.exit(1)
+    print("OK")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,57 @@
+import os
+import json
+import time
+
+os.environ.setdefault('AWS_ACCESS_KEY_ID', 'testing')
+os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'testing')
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-west-2')
+os.environ.setdefault('s3_prefix', 'docs')
+os.environ.setdefault('log_level', 'WARNING')
+
+import aws_clients
+import lambda_function
+from langchain_core.messages import AIMessageChunk
+
+# End-to-end tokens/s of readStreamMsg with a model stub which yields tokens at a fixed rate
+# and a post_to_connection stub with injected latency, for the inline and the thread sender.
+TOKENS = 1000
+TOKEN_INTERVAL = 0.002  # 500 tokens/s from the model
+
+class StubApi:
+    def __init__(self, latency):
+        self.latency = latency
+        self.calls = []
+
+    def post_to_connection(self, ConnectionId, Data):
+        time.sleep(self.latency)
+        self.calls.append(Data)
+
+def model_stream():
+    for i in range(TOKENS):
+        time.sleep(TOKEN_INTERVAL)
+        yield AIMessageChunk(content=f" word{i}")
+
+def measure(sender, latency):
+    api = StubApi(latency)
+    aws_clients.clients[('apigatewaymanagementapi', None, lambda_function.connection_url)] = api
+    lambda_function.stream_sender = sender
+
+    start = time.time()
+    msg, usage = lambda_function.readStreamMsg('connection', 'request', model_stream())
+    elapsed = time.time() - start
+
+    expected = "".join(f" word{i}" for i in range(TOKENS))
+    deltas = [json.loads(data) for data in api.calls]
+    assert msg == expected
+    assert [delta['seq'] for delta in deltas] == list(range(len(deltas)))  # in order
+    assert "".join(delta['msg'] for delta in deltas) == expected  # nothing is lost after the final flush
+    print(f"{sender}, send latency {latency*1000:.0f}ms: {elapsed:.2f}s, {TOKENS/elapsed:.0f} tokens/s, sends {len(api.calls)}")
+
+def main():
+    print(f"model: {TOKENS} tokens at {1/TOKEN_INTERVAL:.0f} tokens/s")
+    for latency in [0.005, 0.02, 0.05]:
+        for sender in ['inline', 'thread']:
+            measure(sender, latency)
+
+if __name__ == '__main__':
+    main()
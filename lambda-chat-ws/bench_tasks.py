@@ -0,0 +1,65 @@
+import os
+import re
+import time
+
+os.environ.setdefault('AWS_ACCESS_KEY_ID', 'testing')
+os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'testing')
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-west-2')
+os.environ.setdefault('s3_prefix', 'docs')
+
+import lambda_function
+from langchain_core.prompts import ChatPromptTemplate
+
+TEXT = "Building a website can be done in 10 simple steps."
+
+def per_request_setup(name):
+    # before: the regex and the prompt were built on every request and the language was checked twice
+    task = lambda_function.tasks[name]
+    for i in range(2):
+        language = 'ko' if re.compile('[\u3131-\u3163\uac00-\ud7a3]+').search(TEXT) else 'en'
+    return ChatPromptTemplate.from_messages([("system", task['system'] if isinstance(task['system'], str) else task['system'][language]), ("human", task['human'])])
+
+def registry_lookup(name):
+    # after: the prompt is looked up with the language which is detected once
+    language = 'ko' if lambda_function.pattern_hangul.search(TEXT) else 'en'
+    return lambda_function.get_prompt(name, language)
+
+def measure(f, n):
+    start = time.time()
+    for i in range(n):
+        for name in lambda_function.tasks:
+            f(name)
+    return (time.time()-start)/(n*len(lambda_function.tasks))
+
+def check_reduce(summary_tokens, budget=100):
+    # the summaries of summary_tokens, near or over the budget, are combined without an input over the budget
+    inputs = []
+    def run_task(connectionId, requestId, name, language, inputs_):
+        inputs.append((name, lambda_function.estimate_tokens(inputs_['input'])))
+        return "word " * int(summary_tokens*3/5)  # 5 bytes per word, 3 bytes per token
+
+    run_task_, max_input_tokens = lambda_function.run_task, lambda_function.summary_max_input_tokens
+    lambda_function.run_task, lambda_function.summary_max_input_tokens = run_task, budget
+    try:
+        summary = lambda_function.get_summary(None, None, (TEXT*4 for i in range(20)))
+    finally:
+        lambda_function.run_task, lambda_function.summary_max_input_tokens = run_task_, max_input_tokens
+    assert summary and inputs[-1][0] == 'summary'
+    over = [(name, tokens) for name, tokens in inputs if tokens > budget]
+    assert not over, f"the inputs over the budget of {budget} tokens: {over}"
+    print(f"reduce: summaries of {summary_tokens} tokens in {len(inputs)} calls, the largest input {max(tokens for name, tokens in inputs)} of {budget} tokens")
+
+def main():
+    check_reduce(90)
+    check_reduce(150)
+
+    n = 200
+    before = measure(per_request_setup, n)
+    after = measure(registry_lookup, n)
+
+    print('per-request prompt build: %0.1fus per request' % (before*1000000))
+    print('registry lookup: %0.1fus per request' % (after*1000000))
+    print('speedup: %0.0fx' % (before/after))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+import time
+import random
+import queue
+import threading
+
+from aws_clients import get_client
+import logger
+
+MAX_BATCH = 25  # the limit of batch_write_item
+
+class BatchWriter:
+    # writes the items in a background thread so that the result can be sent to the client first.
+    # flush() has to be called before the lambda invocation returns since the container is frozen after that.
+    def __init__(self, table_name, keys, max_retries=5, base_delay=0.05, on_write=None):
+        self.table_name = table_name
+        self.keys = keys  # the key attributes of the table
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.on_write = on_write  # called with the write latency in ms and the queue depth of a batch, for the metrics
+        self.queue = queue.Queue()
+        self.thread = None
+        self.lock = threading.Lock()
+        self.written = 0
+        self.failed = 0
+
+    def put(self, item):
+        self.start()
+        self.queue.put((item, time.time()))
+        logger.debug('queued', table=self.table_name, queue_depth=self.queue.qsize())
+
+    def start(self):
+        if self.thread is None or not self.thread.is_alive():
+            with self.lock:
+                if self.thread is None or not self.thread.is_alive():
+                    self.thread = threading.Thread(target=self.run, daemon=True)
+                    self.thread.start()
+
+    def flush(self):
+        # blocks until every queued item is written or given up
+        if self.thread is not None:
+            self.queue.join()
+
+    def run(self):
+        while True:
+            entries = [self.queue.get()]
+            while len(entries) < MAX_BATCH:
+                try:
+                    entries.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            try:
+                self.write(entries)
+            except Exception:
+                logger.exception('Not able to write into dynamodb', table=self.table_name)
+            finally:
+                for entry in entries:
+                    self.queue.task_done()
+
+    def write(self, entries):
+        depth = len(entries) + self.queue.qsize()  # the items which were waiting when the batch started
+        # a batch can not have the same key twice, so the last one wins as put_item did
+        items = dict()
+        for item, enqueued in entries:
+            items[tuple(item[key]['S'] for key in self.keys)] = item
+
+        requests = [{'PutRequest': {'Item': item}} for item in items.values()]
+        dynamodb_client = get_client('dynamodb')
+        for attempt in range(self.max_retries+1):
+            response = dynamodb_client.batch_write_item(RequestItems={self.table_name: requests})
+            requests = response.get('UnprocessedItems', {}).get(self.table_name, [])
+            if not requests:
+                break
+
+            delay = self.base_delay * (2**attempt)
+            logger.warning('unprocessed items', table=self.table_name, items=len(requests), retry_after=round(delay, 3))
+            time.sleep(delay + random.uniform(0, delay))  # exponential backoff with jitter
+
+        if requests:
+            self.failed = self.failed + len(requests)
+            logger.error('Not able to write into dynamodb', table=self.table_name, items=len(requests))
+        self.written = self.written + len(items) - len(requests)
+
+        now = time.time()
+        latency = max(now - enqueued for item, enqueued in entries)
+        logger.info('write', table=self.table_name, latency_ms=round(latency*1000, 1), items=len(items), queue_depth=depth, written=self.written, failed=self.failed)
+        if self.on_write is not None:
+            self.on_write(latency*1000, depth)
@@ -0,0 +1,135 @@
+import os
+import json
+import gzip
+import hashlib
+import tempfile
+import threading
+
+from collections import OrderedDict
+from aws_clients import get_client
+import logger
+
+def document_key(*parts):
+    # the parts are the bucket, the key and the etag of the document and the settings which change the entry
+    return hashlib.sha256(json.dumps(parts, sort_keys=True, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+class DocumentCache:
+    # two tier cache for the extracted chunks and the summaries of the documents: gzipped json files in /tmp with LRU
+    # bounded by max_bytes, and an optional s3 prefix which is shared by the containers. The keys have the etag of
+    # the document, so a document which was uploaded again has new entries and the old ones are evicted.
+    def __init__(self, directory, max_bytes, bucket=None, prefix=None, on_event=None):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.bucket = bucket
+        self.prefix = prefix  # the s3 tier is used if exists
+        self.files = OrderedDict()  # key: size
+        self.total_bytes = 0
+        self.pending = []  # (key, data) which are not uploaded to s3 yet
+        self.lock = threading.Lock()
+        self.local_hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+        self.on_event = on_event  # called with the name of the hit and miss events
+        self.load()
+
+    def load(self):
+        # the files of the previous process in this container, the oldest first
+        os.makedirs(self.directory, exist_ok=True)
+        names = [name for name in os.listdir(self.directory) if name.endswith('.json.gz')]
+        paths = sorted((os.path.join(self.directory, name) for name in names), key=os.path.getmtime)
+        for path in paths:
+            size = os.path.getsize(path)
+            self.files[os.path.basename(path)[:-len('.json.gz')]] = size
+            self.total_bytes = self.total_bytes + size
+        self.evict()
+
+    def path(self, key):
+        return os.path.join(self.directory, key + '.json.gz')
+
+    def event(self, name):
+        if self.on_event is not None:
+            self.on_event(name)
+
+    def get(self, key):
+        with self.lock:
+            found = key in self.files
+            if found:
+                self.files.move_to_end(key)
+        if found:
+            try:
+                with open(self.path(key), 'rb') as f:
+                    value = json.loads(gzip.decompress(f.read()))
+                self.local_hits = self.local_hits + 1
+                self.event('DocumentCacheLocalHits')
+                return value
+            except Exception:
+                logger.exception('Not able to read the document cache', key=key)
+                with self.lock:
+                    self.remove(key)
+
+        if self.prefix is not None:
+            try:
+                data = get_client('s3').get_object(Bucket=self.bucket, Key=self.prefix + key + '.json.gz')['Body'].read()
+                value = json.loads(gzip.decompress(data))
+                self.store(key, data)
+                self.shared_hits = self.shared_hits + 1
+                self.event('DocumentCacheSharedHits')
+                return value
+            except Exception as error:
+                if getattr(error, 'response', {}).get('Error', {}).get('Code') not in ['NoSuchKey', '404']:
+                    logger.exception('Not able to read the document cache from s3', key=key)
+
+        self.misses = self.misses + 1
+
+        self.event('DocumentCacheMisses')
+        return None
+
+    def put(self, key, value):
+        # stored in /tmp at once, upload() sends it to s3 after the result is sent
+        data = gzip.compress(json.dumps(value, ensure_ascii=False).encode('utf-8'))
+        self.store(key, data)
+        if self.prefix is not None:
+            with self.lock:
+                self.pending.append((key, data))
+
+    def upload(self):
+        while self.pending:
+            with self.lock:
+                key, data = self.pending.pop(0)
+            get_client('s3').put_object(Bucket=self.bucket, Key=self.prefix + key + '.json.gz', Body=data, ContentType='application/gzip')
+            logger.info('document cache uploaded', key=key, size=len(data))
+
+    def store(self, key, data):
+        if len(data) > self.max_bytes:
+            return
+        # written into a temporary file and renamed, so that a reader never sees a partial file
+        f = tempfile.NamedTemporaryFile(dir=self.directory, suffix='.tmp', delete=False)
+        try:
+            f.write(data)
+            f.close()
+            os.replace(f.name, self.path(key))
+        except Exception:
+            f.close()
+            os.remove(f.name)
+            raise
+
+        with self.lock:
+            self.total_bytes = self.total_bytes - self.files.pop(key, 0) + len(data)
+            self.files[key] = len(data)
+            self.evict()
+
+    def evict(self):
+        while len(self.files) > 1 and self.total_bytes > self.max_bytes:
+            self.remove(next(iter(self.files)))
+
+    def remove(self, key):
+        size = self.files.pop(key, None)
+        if size is not None:
+            self.total_bytes = self.total_bytes - size
+            try:
+                os.remove(self.path(key))
+            except OSError:
+                pass
+
+    def stats(self):
+        return f"files: {len(self.files)}, bytes: {self.total_bytes}, local hits: {self.local_hits}, shared hits: {self.shared_hits}, misses: {self.misses}"
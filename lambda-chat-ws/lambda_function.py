@@ -1,201 +1,795 @@
 import json
-import boto3
 import os
 import time
 import datetime
-import PyPDF2
 import csv
 import sys
 import re
 import traceback
-
+import tempfile
+import codecs
+import bisect
+import itertools
+import queue
+import threading
+
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from botocore.config import Config
-from io import BytesIO
-from urllib import parse
-from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain.docstore.document import Document
-from langchain.chains.summarize import load_summarize_chain
-from langchain.memory import ConversationBufferMemory
-from langchain_community.chat_models import BedrockChat
-from langchain_core.prompts import MessagesPlaceholder, ChatPromptTemplate
-from langchain.callbacks.streaming_stdout import StreamingStdOutCallbackHandler
-from langchain.memory import ConversationBufferWindowMemory
-from langchain_aws import ChatBedrock
-
-s3 = boto3.client('s3')
+from html.parser import HTMLParser
+from aws_clients import get_client
+from call_log import BatchWriter
+from response_cache import ResponseCache, cache_key
+from request_registry import RequestRegistry
+from document_cache import DocumentCache, document_key
+from tracing import Trace
+from bedrock_pool import ChatPool, Endpoint, CircuitBreaker
+import logger
+
 s3_bucket = os.environ.get('s3_bucket') # bucket name
 s3_prefix = os.environ.get('s3_prefix')
 callLogTableName = os.environ.get('callLogTableName')
+call_log = BatchWriter(callLogTableName, keys=['user_id', 'request_time'])
 bedrock_region = os.environ.get('bedrock_region', 'us-west-2')
 modelId = os.environ.get('model_id', 'amazon.titan-tg1-large')
-print('model_id[:9]: ', modelId[:9])
+logger.info('model', model_id=modelId)
 path = os.environ.get('path')
 doc_prefix = s3_prefix+'/'
+
+# The heavy packages (langchain, PyPDF2, docx, pptx) are imported in the function which uses them first and 
+# the clients and the chat model are created by the first request, so that the cold start only loads what the request needs.
+# bench_imports.py checks that they are not imported again at the module level.
    
 # websocket
 connection_url = os.environ.get('connection_url')
-client = boto3.client('apigatewaymanagementapi', endpoint_url=connection_url)
-print('connection_url: ', connection_url)
+logger.info('websocket', connection_url=connection_url)
+
+# stream mode: 'delta' sends only the appended text, 'snapshot' sends the whole message so far
+stream_mode = os.environ.get('stream_mode', 'delta')
+stream_flush_bytes = int(os.environ.get('stream_flush_bytes', '512'))   # flush when the buffer reaches this size
+stream_flush_interval = float(os.environ.get('stream_flush_interval', '0.05'))  # flush interval in seconds
+# thread: a sender thread posts the messages while the model is read, inline: posted in the loop reading the model
+stream_sender = os.environ.get('stream_sender', 'thread')
+stream_queue_size = int(os.environ.get('stream_queue_size', '8'))  # the messages waiting for the sender
+stream_max_pending = int(os.environ.get('stream_max_pending', str(64*1024)))  # bytes which are coalesced while the queue is full
+# the client which reconnected sends the resume route with the last seq, and gets the rest of the answer from the owner
+stream_replay_bytes = int(os.environ.get('stream_replay_bytes', str(64*1024)))  # the recent messages kept to resume the stream
+stream_checkpoint_interval = float(os.environ.get('stream_checkpoint_interval', '1.0'))  # seconds between the checkpoints to the call log
+stream_resume_grace = float(os.environ.get('stream_resume_grace', '10'))  # seconds to wait for a resume after the connection is gone
+logger.info('stream', stream_mode=stream_mode)
+
+class ConnectionGoneError(Exception):
+    # post_to_connection returned 410 since the client disconnected
+    pass
+
+class CancelledError(Exception):
+    # the generation was stopped since the client disconnected, msg is the partial answer
+    def __init__(self, msg):
+        super().__init__("The request was cancelled")
+        self.msg = msg
+
+gone_connections = set()  # the messages to these connections are not sent again in the request
+resumed_connections = []  # the connections which resumed the stream of the request and get its result
+output_token_price = float(os.environ.get('output_token_price', '0'))  # USD per 1000 output tokens to report the saved cost
+
+# latency of the stages of each request as cloudwatch metrics with the dimensions of convType, modelId and language
+trace = Trace(
+    namespace = os.environ.get('metric_namespace', 'StreamChatbot'),
+    sample_rate = float(os.environ.get('trace_sample_rate', '0'))  # the spans of the sampled requests are also printed
+)
+
+def report_call_log(latency, depth):
+    # the call log is written in the background, so the largest ones in the request are reported
+    trace.maximum('CallLogWriteLatency', latency, 'Milliseconds')
+    trace.maximum('CallLogQueueDepth', depth)
+
+call_log.on_write = report_call_log
+
+HUMAN_PROMPT = "\n\nHuman:"
+AI_PROMPT = "\n\nAssistant:"
+
+def get_parameter(modelId):
+    if modelId == 'amazon.titan-tg1-large' or modelId == 'amazon.titan-tg1-xlarge': 
+        return {
+            "maxTokenCount":1024,
+            "stopSequences":[],
+            "temperature":0,
+            "topP":0.9
+        }
+    elif modelId[:9] == 'anthropic':
+        return {
+            "max_tokens":1024,
+            "temperature":0.1,
+            "top_k":250,
+            "top_p": 0.9,
+            "stop_sequences": [HUMAN_PROMPT]            
+        }
+
+# the chat model is served by the endpoints in "region" or "region:model_id" format, a request fails over to the next endpoint
+# instead of retrying on a throttled one for minutes (bedrock_pool.py)
+bedrock_endpoints = os.environ.get('bedrock_endpoints', bedrock_region).split(',')
+bedrock_client_attempts = int(os.environ.get('bedrock_client_attempts', '3'))  # the attempts of boto3 in an endpoint
+bedrock_max_attempts = int(os.environ.get('bedrock_max_attempts', '3'))  # the endpoints which a request tries
+bedrock_retry_ratio = float(os.environ.get('bedrock_retry_ratio', '0.2'))  # the retries and hedges per request
+bedrock_hedge = os.environ.get('bedrock_hedge', 'false') == 'true'  # send a second request after the p95 latency
+bedrock_breaker_failures = int(os.environ.get('bedrock_breaker_failures', '5'))
+bedrock_breaker_reset = float(os.environ.get('bedrock_breaker_reset', '30'))  # seconds until a trial request after the circuit is opened
+
+def initiate_chat(region, modelId):
+    from langchain_aws import ChatBedrock
 
-def initiate_chat():
     # bedrock   
-    boto3_bedrock = boto3.client(
+    boto3_bedrock = get_client(
         service_name='bedrock-runtime',
-        region_name=bedrock_region,
+        region_name=region,
         config=Config(
-            retries = {
-                'max_attempts': 30
+            retries = {  # the whole retries of the default config is replaced by this
+                'max_attempts': bedrock_client_attempts,
+                'mode': 'adaptive'
             }            
         )
     )
 
-    HUMAN_PROMPT = "\n\nHuman:"
-    AI_PROMPT = "\n\nAssistant:"
-    def get_parameter(modelId):
-        if modelId == 'amazon.titan-tg1-large' or modelId == 'amazon.titan-tg1-xlarge': 
-            return {
-                "maxTokenCount":1024,
-                "stopSequences":[],
-                "temperature":0,
-                "topP":0.9
-            }
-        elif modelId[:9] == 'anthropic':
-            return {
-                "max_tokens":1024,
-                "temperature":0.1,
-                "top_k":250,
-                "top_p": 0.9,
-                "stop_sequences": [HUMAN_PROMPT]            
-            }
-    parameters = get_parameter(modelId)
-
-    """
-    chat = BedrockChat(
-        model_id=modelId,
-        client=boto3_bedrock, 
-        streaming=True,
-        callbacks=[StreamingStdOutCallbackHandler()],
-        model_kwargs=parameters,
-    )  
-    """
-
     chat = ChatBedrock(   # new chat model
         model_id=modelId,
         client=boto3_bedrock, 
-        model_kwargs=parameters,
+        model_kwargs=get_parameter(modelId),
     )    
     return chat
 
-chat = initiate_chat()
+chat = None  # created when the first request needs it
 
-map_chain = dict() 
+def get_chat():
+    global chat
+    if chat is None:
+        endpoints = []
+        for endpoint in bedrock_endpoints:
+            region, model = endpoint.split(':', 1) if ':' in endpoint else (endpoint, modelId)  # model ids can have ':'
+            endpoints.append(Endpoint(f"{region}:{model}", initiate_chat(region, model), CircuitBreaker(bedrock_breaker_failures, bedrock_breaker_reset), model=model))
+        
+        chat = ChatPool(
+            endpoints, 
+            max_attempts=bedrock_max_attempts, 
+            retry_ratio=bedrock_retry_ratio, 
+            hedge=bedrock_hedge, 
+            on_event=trace.count
+        )
+    return chat
+
+def served_model():
+    # the model which answered the last request of this thread, which is another one than modelId when the pool
+    # failed over to an endpoint of "region:model"
+    endpoint = get_chat().served()
+    return endpoint.model if endpoint is not None and endpoint.model else modelId
+
+# cache for the answers of the conversation types which don't use the chat history
+cache_conv_types = os.environ.get('cache_conv_types', 'translation,grammar,sentiment,extraction,pii,step-by-step,timestamp-extraction').split(',')
+response_cache = ResponseCache(
+    max_items = int(os.environ.get('cache_max_items', '1000')),
+    max_bytes = int(os.environ.get('cache_max_bytes', str(16*1024*1024))),
+    table_name = os.environ.get('cacheTableName'),  # shared by the containers if exists
+    ttl = int(os.environ.get('cache_ttl', str(24*60*60))),
+    on_event = trace.count
+)
+
+# a request_id which is sent again gets the stored answer or the answer of the running generation
+dedupe = os.environ.get('dedupe', 'true') == 'true'
+request_registry = RequestRegistry(
+    callLogTableName, 
+    keys=['user_id', 'request_time'], 
+    lease = int(os.environ.get('request_lease', '300'))  # the timeout of the lambda, the claim of an owner which died is taken over after it
+)
+claimed = None  # the call log item of the request which this invocation owns
+completion = None  # (item, msg, status) of the claimed request, which is written after the result is sent
+
+HISTORY_DAYS = 2  # the chat history which is older than this is not used
 MSG_LENGTH = 100
 
-# load documents from s3 for pdf and txt
-def load_document(file_type, s3_file_name):
-    s3r = boto3.resource("s3")
-    doc = s3r.Object(s3_bucket, s3_prefix+'/'+s3_file_name)
+# window: the last k turns with the loaded answers cut at MSG_LENGTH
+# summary: the recent turns within memory_max_tokens and a rolling summary of the older turns (summary_memory.py)
+memory_mode = os.environ.get('memory_mode', 'window')
+memory_max_tokens = int(os.environ.get('memory_max_tokens', '2000'))
+memory_load_turns = int(os.environ.get('memory_load_turns', '20'))  # the turns which are loaded from the call log in summary mode
+
+class MemoryStore:
+    # LRU cache for the chat memory of each user, bounded by the number of users, total bytes and TTL
+    def __init__(self, max_users, max_bytes, ttl):
+        self.max_users = max_users
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.entries = OrderedDict()  # userId: [memory, created time, size]
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, userId):
+        entry = self.entries.get(userId)
+        if entry is None:
+            self.misses = self.misses + 1
+            return None
+        
+        if time.time() - entry[1] > self.ttl:  # the memory was loaded before the allowed time
+            self.remove(userId)
+            self.expirations = self.expirations + 1
+            self.misses = self.misses + 1
+            return None
+        
+        self.entries.move_to_end(userId)
+        self.hits = self.hits + 1
+        return entry[0]
+
+    def put(self, userId, memory):
+        # called whenever the memory of the user is updated in order to refresh its size
+        entry = self.entries.get(userId)
+        if entry is None:
+            entry = [memory, time.time(), 0]
+            self.entries[userId] = entry
+        else:
+            entry[0] = memory
+            self.entries.move_to_end(userId)
+        
+        size = memory_size(memory)
+        self.total_bytes = self.total_bytes + size - entry[2]
+        entry[2] = size
+
+        # evict the least recently used ones except the current user
+        while len(self.entries) > 1 and (len(self.entries) > self.max_users or self.total_bytes > self.max_bytes):
+            oldest = next(iter(self.entries))
+            self.remove(oldest)
+            self.evictions = self.evictions + 1
+
+    def remove(self, userId):
+        entry = self.entries.pop(userId, None)
+        if entry is not None:
+            self.total_bytes = self.total_bytes - entry[2]
+
+    def stats(self):
+        return f"users: {len(self.entries)}, bytes: {self.total_bytes}, hits: {self.hits}, misses: {self.misses}, evictions: {self.evictions}, expirations: {self.expirations}"
+
+def memory_size(memory):
+    # ConversationBufferWindowMemory only reads the last k turns, so older messages are dropped here
+    messages = memory.chat_memory.messages
+    if memory_mode == 'window' and len(messages) > 2*memory.k:
+        del messages[:len(messages)-2*memory.k]
     
-    if file_type == 'pdf':
-        contents = doc.get()['Body'].read()
-        reader = PyPDF2.PdfReader(BytesIO(contents))
+    size = len(memory.summary.encode('utf-8')) if memory_mode == 'summary' else 0
+    for message in messages:
+        size = size + len(str(message.content).encode('utf-8'))
+    return size
+
+map_chain = MemoryStore(
+    max_users = int(os.environ.get('memory_max_users', '1000')),
+    max_bytes = int(os.environ.get('memory_max_bytes', str(64*1024*1024))),
+    ttl = HISTORY_DAYS*24*60*60
+)
+
+# limits of a document
+document_max_bytes = int(os.environ.get('document_max_bytes', str(100*1024*1024)))  # size of the s3 object
+document_max_chars = int(os.environ.get('document_max_chars', '2000000'))  # extracted text
+pdf_max_pages = int(os.environ.get('pdf_max_pages', '1000'))
+pdf_workers = int(os.environ.get('pdf_workers', str(min(os.cpu_count() or 1, 4))))
+PDF_PARALLEL_PAGES = 8  # smaller pdf files are extracted in process
+SPLIT_BUFFER_SIZE = 20000  # characters which are kept before splitting
+SPLIT_VERSION = 2  # in the keys of the cached chunks, so the chunks of an older splitter are not used
+
+# cache of the chunks and the summaries of the documents which are keyed by the etag of the s3 object
+document_cache = DocumentCache(
+    directory = os.environ.get('document_cache_dir', '/tmp/document-cache'),
+    max_bytes = int(os.environ.get('document_cache_max_bytes', str(256*1024*1024))),  # of /tmp
+    bucket = s3_bucket,
+    prefix = os.environ.get('document_cache_prefix'),  # shared by the containers if exists
+    on_event = trace.count
+)
+document_cache_max_chars = int(os.environ.get('document_cache_max_chars', str(document_max_chars)))  # the chunks of larger csv files are not cached
+
+def cache_chunks(key, segments):
+    # passes the chunks through, and caches them when the whole document was read
+    chunks = []
+    length = 0
+    for text, metadata in segments:
+        if chunks is not None:
+            length = length + len(text)
+            if length <= document_cache_max_chars:
+                chunks.append([text, metadata])
+            else:
+                chunks = None
+        yield text, metadata
+    if chunks is not None:
+        document_cache.put(key, chunks)
+
+def get_document_object(s3_file_name, max_bytes=None):
+    max_bytes = max_bytes or document_max_bytes
+    doc = get_client('s3').get_object(Bucket=s3_bucket, Key=s3_prefix+'/'+s3_file_name)
+    logger.info('document', name=s3_file_name, size=doc['ContentLength'])
+    if doc['ContentLength'] > max_bytes:
+        doc['Body'].close()
+        raise Exception (f"The document is larger than {max_bytes} bytes")
+    return doc
+
+def save_document(s3_file_name, f):
+    # the body is streamed into a temporary file instead of the memory
+    doc = get_document_object(s3_file_name)
+    for chunk in doc['Body'].iter_chunks(1024*1024):
+        f.write(chunk)
+    f.flush()
+
+# Every document loader yields (text, metadata) segments lazily.
+def extract_pdf_pages(file_name, worker, workers, pages, conn):
+    # runs in a child process and sends the text of every workers-th page in order
+    import PyPDF2
+    reader = PyPDF2.PdfReader(file_name)
+    for i in range(worker, pages, workers):
+        try:
+            text = reader.pages[i].extract_text()
+        except Exception:
+            text = ""
+        conn.send(text)
+    conn.close()
+
+def read_pdf_pages(s3_file_name):
+    import PyPDF2
+    import multiprocessing
+    with tempfile.NamedTemporaryFile(dir='/tmp', suffix='.pdf') as f:
+        save_document(s3_file_name, f)
+
+        reader = PyPDF2.PdfReader(f.name)
+        pages = min(len(reader.pages), pdf_max_pages)
+        logger.info('pdf', pages=len(reader.pages), extracted_pages=pages)
         
-        raw_text = []
-        for page in reader.pages:
-            raw_text.append(page.extract_text())
-        contents = '\n'.join(raw_text)    
+        if pages < PDF_PARALLEL_PAGES or pdf_workers <= 1:
+            for i in range(pages):
+                yield reader.pages[i].extract_text(), {'page': i+1}
+            return
+        del reader
+
+        # multiprocessing.Pool needs /dev/shm which lambda doesn't have, so processes with pipes are used
+        ctx = multiprocessing.get_context('fork')
+        workers = min(pdf_workers, pages)
+        conns = []
+        processes = []
+        for worker in range(workers):
+            parent_conn, child_conn = ctx.Pipe(duplex=False)
+            process = ctx.Process(target=extract_pdf_pages, args=(f.name, worker, workers, pages, child_conn), daemon=True)
+            process.start()
+            child_conn.close()
+            conns.append(parent_conn)
+            processes.append(process)
         
-    elif file_type == 'txt':        
-        contents = doc.get()['Body'].read().decode('utf-8')
+        try:
+            for i in range(pages):
+                yield conns[i % workers].recv(), {'page': i+1}
+        finally:  # the consumer can stop early
+            for process in processes:
+                if process.is_alive():
+                    process.terminate()
+                process.join()
+            for conn in conns:
+                conn.close()
+
+def read_text_lines(s3_file_name):
+    doc = get_document_object(s3_file_name)
+    n = 0
+    for line in doc['Body'].iter_lines():
+        n = n + 1
+        yield line.decode('utf-8'), {'line': n}
+
+def read_csv_rows(s3_file_name):
+    yield from sample_csv_rows(s3_file_name)
+
+def read_docx_paragraphs(s3_file_name):
+    import docx
+    with tempfile.NamedTemporaryFile(dir='/tmp', suffix='.docx') as f:
+        save_document(s3_file_name, f)
+        document = docx.Document(f.name)
+
+        n = 0
+        for paragraph in document.paragraphs:
+            n = n + 1
+            yield paragraph.text, {'paragraph': n}
         
-    print('contents: ', contents)
-    new_contents = str(contents).replace("\n"," ") 
-    print('length: ', len(new_contents))
-
+        n = 0
+        for table in document.tables:
+            n = n + 1
+            for row in table.rows:
+                yield " | ".join(cell.text for cell in row.cells), {'table': n}
+
+def read_pptx_slides(s3_file_name):
+    from pptx import Presentation
+    with tempfile.NamedTemporaryFile(dir='/tmp', suffix='.pptx') as f:
+        save_document(s3_file_name, f)
+        presentation = Presentation(f.name)
+
+        n = 0
+        for slide in presentation.slides:
+            n = n + 1
+            texts = []
+            for shape in slide.shapes:
+                if shape.has_text_frame:
+                    texts.append(shape.text_frame.text)
+            yield "\n".join(texts), {'slide': n}
+
+class HTMLTextParser(HTMLParser):
+    # collects the text of a html document except scripts and styles
+    def __init__(self):
+        super().__init__()
+        self.texts = []
+        self.skip = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in ('script', 'style'):
+            self.skip = self.skip + 1
+
+    def handle_endtag(self, tag):
+        if tag in ('script', 'style') and self.skip:
+            self.skip = self.skip - 1
+
+    def handle_data(self, data):
+        if not self.skip and data.strip():
+            self.texts.append(data.strip())
+
+def read_html_text(s3_file_name):
+    doc = get_document_object(s3_file_name)
+    decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+    parser = HTMLTextParser()
+    for chunk in doc['Body'].iter_chunks(64*1024):
+        parser.feed(decoder.decode(chunk))
+        if parser.texts:
+            yield " ".join(parser.texts), {}
+            parser.texts = []
+    parser.feed(decoder.decode(b'', final=True))
+    parser.close()
+    if parser.texts:
+        yield " ".join(parser.texts), {}
+
+def read_json_values(s3_file_name):
+    doc = get_document_object(s3_file_name)
+    data = json.load(doc['Body'])
+
+    # flattens the values with their paths
+    stack = [("", data)]
+    while stack:
+        key, value = stack.pop()
+        if isinstance(value, dict):
+            stack.extend((f"{key}.{k}" if key else str(k), v) for k, v in reversed(list(value.items())))
+        elif isinstance(value, list):
+            stack.extend((f"{key}[{i}]", v) for i, v in reversed(list(enumerate(value))))
+        else:
+            yield f"{key}: {value}", {'path': key}
+
+# the loaders of the document by the file extension
+document_loaders = {
+    'pdf': read_pdf_pages,
+    'txt': read_text_lines,
+    'md': read_text_lines,
+    'csv': read_csv_rows,
+    'docx': read_docx_paragraphs,
+    'pptx': read_pptx_slides,
+    'html': read_html_text,
+    'json': read_json_values,
+}
+
+def split_buffer(text_splitter, buffer, marks):
+    # splits the buffer and finds the metadata of the segment where each chunk starts. The offsets come from the
+    # splitter, which searches each chunk after the previous one, so a repeated text is not matched to an earlier copy.
+    offsets = [offset for offset, metadata in marks]
+    chunks = []
+    for document in text_splitter.create_documents([buffer]):
+        position = document.metadata['start_index']
+        chunks.append((document.page_content, marks[bisect.bisect_right(offsets, position)-1][1], position))
+    return chunks
+
+def split_text_stream(segments):
+    # splits the text incrementally so that the whole document is not kept in memory
+    from langchain.text_splitter import RecursiveCharacterTextSplitter
     text_splitter = RecursiveCharacterTextSplitter(
         chunk_size=1000,
         chunk_overlap=100,
         separators=["\n\n", "\n", ".", " ", ""],
         length_function = len,
+        add_start_index = True
     ) 
 
-    texts = text_splitter.split_text(new_contents) 
-    print('texts[0]: ', texts[0])
-    
-    return texts
+    buffer = ""
+    marks = []  # (offset in the buffer, metadata) of each segment
+    length = 0
+    for segment, metadata in segments:
+        if not segment:
+            continue
+        segment = segment.replace("\n"," ") + " "
+        if length + len(segment) > document_max_chars:
+            logger.warning('the document is truncated', length=length)
+            segment = segment[:document_max_chars-length]
+        length = length + len(segment)
+        marks.append((len(buffer), metadata))
+        buffer = buffer + segment
+
+        if len(buffer) >= SPLIT_BUFFER_SIZE:
+            chunks = split_buffer(text_splitter, buffer, marks)
+            for text, chunk_metadata, position in chunks[:-1]:
+                yield text, chunk_metadata
+            
+            # the last chunk can be continued by the next segment
+            text, chunk_metadata, position = chunks[-1]
+            buffer = buffer[position:]
+            marks = [(0, chunk_metadata)] + [(offset-position, m) for offset, m in marks if offset > position]
 
-# load csv documents from s3
-def load_csv_document(s3_file_name):
-    s3r = boto3.resource("s3")
-    doc = s3r.Object(s3_bucket, s3_prefix+'/'+s3_file_name)
+        if length >= document_max_chars:
+            break
+    
+    if buffer.strip():
+        for text, chunk_metadata, position in split_buffer(text_splitter, buffer, marks):
+            yield text, chunk_metadata
+    logger.info('document length', length=length)
 
-    lines = doc.get()['Body'].read().decode('utf-8').split('\n')   # read csv per line
-    print('lins: ', len(lines))
-        
-    columns = lines[0].split(',')  # get columns
-    #columns = ["Category", "Information"]  
-    #columns_to_metadata = ["type","Source"]
-    print('columns: ', columns)
+# load documents from s3 by the loader of the file type
+def load_document(file_type, s3_file_name):
+    if file_type not in document_loaders:
+        raise Exception (f"Not supported file type: {file_type}")
     
-    docs = []
+    segments = document_loaders[file_type](s3_file_name)
+    return split_text_stream(segments)
+
+# load csv documents from s3 row by row
+csv_max_bytes = int(os.environ.get('csv_max_bytes', str(1024*1024*1024)))  # rows are streamed, so larger files are allowed
+csv_sample_mode = os.environ.get('csv_sample_mode', 'auto')  # all, head, stratified or auto
+csv_sample_rows = int(os.environ.get('csv_sample_rows', '2000'))
+csv_sample_threshold = int(os.environ.get('csv_sample_threshold', str(5*1024*1024)))  # auto mode samples larger files
+CSV_PROBE_ROWS = 100  # rows which are used to estimate the number of rows
+
+def iter_csv_rows(doc, counter=None):
+    # lines keep their line breaks so that DictReader can parse quoted fields with new lines
+    def lines():
+        for line in doc['Body'].iter_lines(keepends=True):
+            if counter is not None:
+                counter[0] = counter[0] + len(line)
+            yield line.decode('utf-8')
+
     n = 0
-    for row in csv.DictReader(lines, delimiter=',',quotechar='"'):
-        # print('row: ', row)
-        #to_metadata = {col: row[col] for col in columns_to_metadata if col in row}
-        values = {k: row[k] for k in columns if k in row}
-        content = "\n".join(f"{k.strip()}: {v.strip()}" for k, v in values.items())
-        doc = Document(
-            page_content=content,
-            metadata={
-                'name': s3_file_name,
-                'row': n+1,
-            }
-            #metadata=to_metadata
-        )
-        docs.append(doc)
-        n = n+1
-    print('docs[0]: ', docs[0])
+    for row in csv.DictReader(lines(), delimiter=',', quotechar='"'):
+        n = n + 1
+        content = "\n".join(f"{k.strip()}: {v.strip()}" for k, v in row.items() if k is not None and v is not None)
+        yield content, {'row': n}
+
+def sample_csv_rows(s3_file_name):
+    doc = get_document_object(s3_file_name, csv_max_bytes)
+    size = doc['ContentLength']
+
+    mode = csv_sample_mode
+    if mode == 'auto':
+        mode = 'stratified' if size > csv_sample_threshold else 'all'
+    logger.info('csv sample', mode=mode)
+
+    if mode == 'head':
+        yield from itertools.islice(iter_csv_rows(doc), csv_sample_rows)
+    elif mode == 'stratified':
+        # takes every step-th row so that the samples are spread evenly over the file
+        counter = [0]
+        rows = iter_csv_rows(doc, counter)
+        probe = list(itertools.islice(rows, CSV_PROBE_ROWS))
+        if not probe:
+            return
+        estimated_rows = int(size / (counter[0] / len(probe)))
+        step = max(1, estimated_rows // csv_sample_rows)
+        logger.info('csv sample', estimated_rows=estimated_rows, step=step)
+
+        n = 0
+        for row in itertools.chain(probe, rows):
+            if n % step == 0:
+                yield row
+            n = n + 1
+    else:
+        yield from iter_csv_rows(doc)
+
+# summarization
+summary_mode = os.environ.get('summary_mode', 'map_reduce')  # stuff, map_reduce or refine
+summary_max_input_tokens = int(os.environ.get('summary_max_input_tokens', '8000'))  # the input budget of a call
+summary_concurrency = int(os.environ.get('summary_concurrency', '4'))
+
+def estimate_tokens(text):
+    # conservative estimation without a tokenizer: about 3 bytes per token for English and Korean
+    return (len(text.encode('utf-8'))+2)//3
+
+def iter_groups(texts, max_tokens):
+    # packs the consecutive texts into groups which are smaller than max_tokens
+    group = []
+    tokens = 0
+    for text in texts:
+        size = estimate_tokens(text)
+        if group and tokens + size > max_tokens:
+            yield group
+            group = []
+            tokens = 0
+        group.append(text)
+        tokens = tokens + size
+    if group:
+        yield group
+
+def group_by_tokens(texts, max_tokens):
+    return list(iter_groups(texts, max_tokens))
+
+def truncate_tokens(text, max_tokens):
+    # cuts the text so that estimate_tokens is at most max_tokens, at a character boundary
+    data = text.encode('utf-8')
+    if len(data) <= max_tokens*3 - 2:
+        return text
+    return data[:max(0, max_tokens*3 - 2)].decode('utf-8', errors='ignore')
+
+def sendProgressMessage(connectionId, requestId, msg):
+    if connectionId is None:
+        return
+    result = {
+        'request_id': requestId,
+        'msg': msg,
+        'status': 'progress'
+    }
+    sendMessage(connectionId, result)
 
-    return docs
+def map_summaries(connectionId, requestId, language, groups):
+    # summarizes the groups concurrently while only a few groups are loaded at once
+    summaries = []
+    futures = dict()  # future: index of the summary
+    with ThreadPoolExecutor(max_workers=summary_concurrency) as executor:
+        def collect(done):
+            for future in done:
+                summaries[futures.pop(future)] = future.result()
+            sendProgressMessage(connectionId, requestId, f"Summarized {len(summaries)-len(futures)} parts")
 
-def get_summary(chat, docs):    
-    text = ""
-    for doc in docs:
-        text = text + doc
-    
-    if isKorean(text)==True:
-        system = (
-            "다음의 <article> tag안의 문장을 요약해서 500자 이내로 설명하세오."
-        )
-    else: 
-        system = (
-            "Here is pieces of article, contained in <article> tags. Write a concise summary within 500 characters."
-        )
-    
-    human = "<article>{text}</article>"
+        try:
+            for group in groups:
+                if len(futures) >= summary_concurrency*2:
+                    done, pending = wait(futures, return_when=FIRST_COMPLETED)
+                    collect(done)
+                futures[executor.submit(run_task, None, None, 'summary-map', language, {"input": "\n".join(group)})] = len(summaries)
+                summaries.append(None)
+            
+            done, pending = wait(futures)
+            collect(done)
+        except ConnectionGoneError:  # the groups which are not started yet are not summarized
+            for future in futures:
+                future.cancel()
+            raise CancelledError("")
+    return summaries
+
+def get_summary(connectionId, requestId, docs):    
+    # docs can be a generator, so the groups are made while summarizing
+    groups = iter_groups(docs, summary_max_input_tokens)
+    head = list(itertools.islice(groups, 2))
+    groups = itertools.chain(head, groups)
+    language = getLanguage("\n".join(head[0])) if head else 'en'
+    trace.set_dimension('language', language)
+    logger.info('summary', mode=summary_mode)
+
+    if summary_mode == 'stuff' or len(head) <= 1:  # a single request is enough
+        text = "\n".join("\n".join(group) for group in groups)
+        summary = run_task(None, None, 'summary', language, {"input": text})
     
-    prompt = ChatPromptTemplate.from_messages([("system", system), ("human", human)])
-    print('prompt: ', prompt)
+    elif summary_mode == 'refine':
+        summary = None
+        n = 0
+        for group in groups:
+            n = n + 1
+            if summary is None:
+                summary = run_task(None, None, 'summary', language, {"input": "\n".join(group)})
+            else:
+                sendProgressMessage(connectionId, requestId, f"Summarizing part {n}")
+                summary = run_task(None, None, 'summary-refine', language, {"input": "\n".join(group), "summary": summary})
     
-    chain = prompt | chat    
-    try: 
-        result = chain.invoke(
-            {
-                "text": text
-            }
-        )
+    else: # map_reduce
+        summaries = map_summaries(connectionId, requestId, language, groups)
+        logger.info('summary', groups=len(summaries))
         
-        summary = result.content
-        print('result of summarization: ', summary)
-    except Exception:
-        err_msg = traceback.format_exc()
-        print('error message: ', err_msg)                    
-        raise Exception ("Not able to request to LLM")
+        # reduce: combine the summaries hierarchically until they fit in a single request
+        level = 0
+        while True:
+            groups = group_by_tokens(summaries, summary_max_input_tokens)
+            if len(groups) == 1:
+                break
+            if len(groups) == len(summaries):  # no two summaries fit in a request, so they are cut to the half of the budget
+                summaries = [truncate_tokens(summary, (summary_max_input_tokens-1)//2) for summary in summaries]
+                groups = group_by_tokens(summaries, summary_max_input_tokens)
+                logger.warning('summaries are truncated', summaries=len(summaries), groups=len(groups))
+            level = level + 1
+            sendProgressMessage(connectionId, requestId, f"Combining {len(summaries)} summaries (level {level})")
+            with ThreadPoolExecutor(max_workers=summary_concurrency) as executor:
+                summaries = list(executor.map(lambda group: run_task(None, None, 'summary-combine', language, {"input": "\n\n".join(group)}), groups))
+        
+        summary = run_task(None, None, 'summary', language, {"input": truncate_tokens("\n\n".join(summaries), summary_max_input_tokens)})  # a single summary can be over the budget
     
+    logger.debug('result of summarization', summary=summary)
     return summary
-    
+
+# ask your document: the chunks of the uploaded documents are embedded after the summary is sent, and the questions
+# of the user are answered with the top k chunks of the documents in the session, so the prompt does not grow with the documents
+retrieval = os.environ.get('retrieval', 'false') == 'true'  # every uploaded document is embedded when it is enabled
+embedding_model_id = os.environ.get('embedding_model_id', 'cohere.embed-multilingual-v3')  # 'local' for the deterministic stand-in
+embedding_batch_size = int(os.environ.get('embedding_batch_size', '96'))  # the texts in a request of cohere
+embedding_concurrency = int(os.environ.get('embedding_concurrency', '4'))
+retrieval_top_k = int(os.environ.get('retrieval_top_k', '4'))
+retrieval_min_score = float(os.environ.get('retrieval_min_score', '0.2'))  # the less similar chunks are not used
+retrieval_max_chunks = int(os.environ.get('retrieval_max_chunks', '20000'))  # which are indexed in a document
+vector_indexes = None  # created when it is used first, so numpy is not imported in the init phase
+user_documents = OrderedDict()  # user_id: the index keys of the documents in the session, the oldest first
+
+def get_vector_indexes():
+    global vector_indexes
+    if vector_indexes is None:
+        from vector_index import IndexStore
+        vector_indexes = IndexStore(
+            directory = os.environ.get('vector_index_dir', '/tmp/vector-index'),
+            max_bytes = int(os.environ.get('vector_index_max_bytes', str(128*1024*1024))),  # in the memory and /tmp
+            bucket = s3_bucket,
+            prefix = os.environ.get('vector_index_prefix')  # shared by the containers if exists
+        )
+    return vector_indexes
+
+def embed_texts(texts, input_type):
+    # returns the normalized embeddings as a float32 matrix. input_type is search_document or search_query.
+    from vector_index import normalize, hash_embedding
+    if embedding_model_id == 'local':
+        return hash_embedding(texts)
+
+    bedrock_client = get_client('bedrock-runtime', region_name=bedrock_region)
+    def embed(batch):
+        if embedding_model_id.startswith('cohere'):
+            body = {"texts": batch, "input_type": input_type, "truncate": "END"}
+            response = bedrock_client.invoke_model(modelId=embedding_model_id, body=json.dumps(body), accept='application/json', contentType='application/json')
+            return json.loads(response['body'].read())['embeddings']
+        else:  # titan embeds a text in a request
+            embeddings = []
+            for text in batch:
+                response = bedrock_client.invoke_model(modelId=embedding_model_id, body=json.dumps({"inputText": text}), accept='application/json', contentType='application/json')
+                embeddings.append(json.loads(response['body'].read())['embedding'])
+            return embeddings
+
+    batches = [texts[i:i+embedding_batch_size] for i in range(0, len(texts), embedding_batch_size)]
+    with ThreadPoolExecutor(max_workers=embedding_concurrency) as executor:
+        embeddings = [embedding for result in executor.map(embed, batches) for embedding in result]
+    return normalize(embeddings)
+
+def add_user_document(userId, key):
+    keys = user_documents.pop(userId, [])
+    user_documents[userId] = [k for k in keys if k != key] + [key]
+    while len(user_documents) > map_chain.max_users:
+        user_documents.popitem(last=False)
+
+def index_document(userId, key, chunks_key, file_type, object, item):
+    # the index of a document is shared by the users and the containers which got the same document. The document
+    # joins the session of the user only when it is indexed, so a failure doesn't make the questions search it.
+    indexes = get_vector_indexes()
+    if indexes.get(key) is None:
+        with trace.span('DocumentIndexing'):
+            chunks = document_cache.get(chunks_key)
+            if chunks is None:  # the summary was cached or the document is too large to cache
+                segments = sample_csv_rows(object) if file_type == 'csv' else load_document(file_type, object)
+                chunks = [[text, metadata] for text, metadata in itertools.islice(segments, retrieval_max_chunks)]
+            chunks = chunks[:retrieval_max_chunks]
+
+            from vector_index import VectorIndex
+            index = indexes.put(key, VectorIndex(embed_texts([text for text, metadata in chunks], 'search_document'), chunks))
+        logger.info('document indexed', chunks=len(chunks), dimension=index.vectors.shape[1], stats=indexes.stats())
+    add_user_document(userId, key)
+    item['documents'] = {'SS':user_documents[userId]}
+    call_log.put(item)  # for the containers which load the history
+
+def retrieve(userId, text):
+    # the top k chunks of the documents of the user which are similar to the question
+    keys = user_documents.get(userId, [])
+    with trace.span('Retrieval'):
+        vector = embed_texts([text], 'search_query')[0]
+        found = []
+        for key in keys:
+            index = get_vector_indexes().get(key)
+            if index is not None:  # not indexed yet by the other container
+                found.extend(index.search(vector, retrieval_top_k))
+        found = sorted((result for result in found if result[0] >= retrieval_min_score), key=lambda result: -result[0])[:retrieval_top_k]
+    logger.info('retrieval', documents=len(keys), chunks=len(found), scores=[round(score, 3) for score, chunk, metadata in found])
+    trace.count('RetrievedChunks', len(found))
+    return "\n\n".join(chunk for score, chunk, metadata in found)
+
 def load_chatHistory(userId, allowTime, chat_memory):
-    dynamodb_client = boto3.client('dynamodb')
+    dynamodb_client = get_client('dynamodb')
 
     response = dynamodb_client.query(
         TableName=callLogTableName,
@@ -205,7 +799,7 @@ def load_chatHistory(userId, allowTime, chat_memory):
             ':allowTime': {'S': allowTime}
         }
     )
-    print('query result: ', response['Items'])
+    logger.debug('query result', items=response['Items'])
 
     for item in response['Items']:
         text = item['body']['S']
@@ -213,74 +807,33 @@ def load_chatHistory(userId, allowTime, chat_memory):
         type = item['type']['S']
 
         if type == 'text':
-            print('text: ', text)
-            print('msg: ', msg)        
+            logger.debug('history', text=text, msg=msg)
 
             chat_memory.save_context({"input": text}, {"output": msg})             
 
 def getAllowTime():
-    d = datetime.datetime.now() - datetime.timedelta(days = 2)
+    d = datetime.datetime.now() - datetime.timedelta(days = HISTORY_DAYS)
     timeStr = str(d)[0:19]
-    print('allow time: ',timeStr)
+    logger.debug('allow time', allow_time=timeStr)
 
     return timeStr
 
+pattern_hangul = re.compile('[\u3131-\u3163\uac00-\ud7a3]+')
+
 def isKorean(text):
     # check korean
-    pattern_hangul = re.compile('[\u3131-\u3163\uac00-\ud7a3]+')
     word_kor = pattern_hangul.search(str(text))
     # print('word_kor: ', word_kor)
 
     if word_kor and word_kor != 'None':
-        print('Korean: ', word_kor)
+        logger.debug('Korean', word=word_kor.group())
         return True
     else:
-        print('Not Korean: ', word_kor)
+        logger.debug('Not Korean')
         return False
 
-def general_conversation(connectionId, requestId, chat, query):
-    if isKorean(query)==True :
-        system = (
-            "다음의 Human과 Assistant의 친근한 이전 대화입니다. Assistant은 상황에 맞는 구체적인 세부 정보를 충분히 제공합니다. Assistant의 이름은 서연이고, 모르는 질문을 받으면 솔직히 모른다고 말합니다."
-        )
-    else: 
-        system = (
-            "Using the following conversation, answer friendly for the newest question. If you don't know the answer, just say that you don't know, don't try to make up an answer. You will be acting as a thoughtful advisor."
-        )
-    
-    human = "{input}"
-    
-    prompt = ChatPromptTemplate.from_messages([("system", system), MessagesPlaceholder(variable_name="history"), ("human", human)])
-    print('prompt: ', prompt)
-    
-    history = memory_chain.load_memory_variables({})["chat_history"]
-    print('memory_chain: ', history)
-                
-    chain = prompt | chat    
-    try: 
-        isTyping(connectionId, requestId)  
-        stream = chain.invoke(
-            {
-                "history": history,
-                "input": query,
-            }
-        )
-        msg = readStreamMsg(connectionId, requestId, stream.content)    
-        
-        usage = stream.response_metadata['usage']
-        print('prompt_tokens: ', usage['prompt_tokens'])
-        print('completion_tokens: ', usage['completion_tokens'])
-        print('total_tokens: ', usage['total_tokens'])
-        msg = stream.content
-
-    except Exception:
-        err_msg = traceback.format_exc()
-        print('error message: ', err_msg)        
-            
-        sendErrorMessage(connectionId, requestId, err_msg)    
-        raise Exception ("Not able to request to LLM")
-    
-    return msg
+def getLanguage(text):
+    return 'ko' if isKorean(text) else 'en'
 
 def isTyping(connectionId, requestId):    
     msg_proceeding = {
@@ -291,32 +844,225 @@ def isTyping(connectionId, requestId):
     #print('result: ', json.dumps(result))
     sendMessage(connectionId, msg_proceeding)
         
-def readStreamMsg(connectionId, requestId, stream):
-    msg = ""
-    if stream:
-        for event in stream:
-            #print('event: ', event)
-            msg = msg + event
-
+class StreamBuffer:
+    # coalesces streamed text and sends it when the buffer is big enough or the interval has passed.
+    # In thread mode the messages are posted by a sender thread in order, so a slow post_to_connection doesn't stall
+    # reading the model. While the queue is full the text is coalesced into the next message, and the reader only
+    # waits when more than stream_max_pending bytes are pending.
+    # The messages are numbered by seq and the recent ones are kept for a client which reconnects. When the request is
+    # claimed, the text is checkpointed to the call log, which also hands over the resumes of the new connections.
+    # After the connection is gone the generation goes on for stream_resume_grace, and is cancelled if no one resumed.
+    def __init__(self, connectionId, requestId):
+        self.connectionId = connectionId
+        self.requestId = requestId
+        self.mode = stream_mode
+        self.msg = ""      # the whole message so far
+        self.pending = ""  # the text which is not sent yet
+        self.pending_bytes = 0
+        self.seq = 0
+        self.last_flush = 0.0
+        self.sends = 0
+        self.sent_bytes = 0
+        self.queue = queue.Queue(maxsize=stream_queue_size)
+        self.sender = None
+        self.error = None  # the error of the sender which is raised in the reader
+        self.targets = [connectionId]  # the connections which get the messages
+        self.replay = deque()  # (seq, message, length of msg) of the recent messages
+        self.replay_bytes = 0
+        self.lock = threading.Lock()
+        self.last_checkpoint = time.time()
+        self.detached = None  # the time when the last connection was gone
+
+    def append(self, text):
+        if self.error is not None:
+            raise self.error
+        if self.detached is not None and time.time() - self.detached > stream_resume_grace:
+            logger.info('no connection resumed the stream', grace=stream_resume_grace)
+            raise ConnectionGoneError(self.connectionId)
+        self.msg = self.msg + text
+        self.pending = self.pending + text
+        self.pending_bytes = self.pending_bytes + len(text.encode('utf-8'))
+
+        if self.pending_bytes >= stream_flush_bytes or time.time() - self.last_flush >= stream_flush_interval:
+            self.flush(block=self.pending_bytes >= stream_max_pending)
+
+    def flush(self, block=True):
+        if not self.pending:
+            return
+        if stream_sender == 'thread' and not block and self.queue.full():
+            return
+        
+        if self.mode == 'snapshot':
             result = {
-                'request_id': requestId,
-                'msg': msg,
+                'request_id': self.requestId,
+                'msg': self.msg,
+                'seq': self.seq,
                 'status': 'proceeding'
             }
-            #print('result: ', json.dumps(result))
-            sendMessage(connectionId, result)
+        else:
+            result = {
+                'request_id': self.requestId,
+                'msg': self.pending,
+                'seq': self.seq,
+                'status': 'delta'
+            }
+        self.seq = self.seq + 1
+        #print('result: ', json.dumps(result))
+        
+        size = len(result['msg'].encode('utf-8'))
+        with self.lock:
+            self.replay.append((result['seq'], result, len(self.msg)))
+            self.replay_bytes = self.replay_bytes + size
+            while len(self.replay) > 1 and self.replay_bytes > stream_replay_bytes:
+                self.replay_bytes = self.replay_bytes - len(self.replay.popleft()[1]['msg'].encode('utf-8'))
+
+        if stream_sender == 'thread':
+            if self.sender is None:
+                self.sender = threading.Thread(target=self.run, daemon=True)
+                self.sender.start()
+            self.queue.put((result, len(self.msg)))
+        else:
+            self.send(result, len(self.msg))
+
+        self.pending = ""
+        self.pending_bytes = 0
+        self.last_flush = time.time()
+
+    def send(self, result, end):
+        # end is the length of msg which was sent with the result
+        for connectionId in list(self.targets):
+            try:
+                sendMessage(connectionId, result)
+            except ConnectionGoneError:
+                self.targets.remove(connectionId)
+        
+        if self.targets:
+            self.sends = self.sends + 1
+            self.sent_bytes = self.sent_bytes + len(result['msg'].encode('utf-8'))
+        elif self.detached is None:
+            if claimed is None:  # no one can resume it
+                raise ConnectionGoneError(self.connectionId)
+            logger.info('the connection is gone, waiting for a resume', grace=stream_resume_grace)
+            self.detached = time.time()
+        
+        if claimed is not None and time.time() - self.last_checkpoint >= stream_checkpoint_interval:
+            self.checkpoint(result['seq'], end)
+
+    def checkpoint(self, seq, end):
+        self.last_checkpoint = time.time()
+        try:
+            resumes = request_registry.checkpoint(claimed, self.connectionId, self.msg[:end], seq+1)
+        except Exception:  # the stream goes on without the checkpoint
+            logger.exception('Not able to checkpoint the stream')
+            return
+        for connectionId, next_seq in resumes or []:
+            self.resume(connectionId, next_seq, seq, end)
+
+    def resume(self, connectionId, next_seq, seq, end):
+        # sends the messages from next_seq to seq, or the whole text if they are not kept any more, and then the live ones
+        with self.lock:
+            messages = [result for s, result, length in self.replay if next_seq <= s <= seq]
+            oldest = self.replay[0][0] if self.replay else seq+1
+        try:
+            if self.mode == 'snapshot' or next_seq < oldest:
+                sendMessage(connectionId, {
+                    'request_id': self.requestId,
+                    'msg': self.msg[:end],
+                    'seq': seq+1,  # the next one
+                    'status': 'resume'
+                })
+            else:
+                for result in messages:
+                    sendMessage(connectionId, result)
+        except ConnectionGoneError:
+            return
+        logger.info('the stream is resumed', resumed_connection=connectionId, seq=next_seq, replayed=len(messages))
+        trace.count('StreamResumes')
+        self.targets.append(connectionId)
+        resumed_connections.append(connectionId)
+        self.detached = None
+
+    def run(self):
+        while True:
+            entry = self.queue.get()
+            if entry is None:
+                return
+            if self.error is None:  # the rest is dropped after an error
+                try:
+                    self.send(*entry)
+                except Exception as error:
+                    self.error = error
+
+    def close(self):
+        # flushes the rest and waits until every message is sent
+        self.flush()
+        self.stop()
+        if self.error is not None:
+            raise self.error
+
+    def stop(self):
+        if self.sender is not None:
+            self.queue.put(None)
+            self.sender.join()
+            self.sender = None
+
+def readStreamMsg(connectionId, requestId, stream, tag=None):
+    # stream is the iterator of AIMessageChunk returned by ChatPool.stream(), only the text in the tag is sent if tag is given
+    buffer = StreamBuffer(connectionId, requestId)
+    tag_filter = TagFilter(tag) if tag else None
+    usage = None
+    start = time.time()
+    first = True
+    if stream:
+        try:
+            for event in stream:
+                #print('event: ', event)
+                if event.usage_metadata:  # the last chunk carries the token usage
+                    usage = event.usage_metadata
+                
+                if not event.content:
+                    continue
+                if first:
+                    trace.record('TimeToFirstToken', start)
+                    first = False
+                
+                text = tag_filter.feed(event.content) if tag_filter else event.content
+                if text:
+                    buffer.append(text)
+            if tag_filter:
+                buffer.append(tag_filter.finish())
+            buffer.close()
+        except ConnectionGoneError:  
+            # stop reading the model, closing the stream closes the response of bedrock
+            close = getattr(stream, 'close', None)
+            if close is not None:
+                close()
+            logger.info('stream', sends=buffer.sends, bytes=buffer.sent_bytes, cancelled=True)
+            raise CancelledError(buffer.msg)
+        finally:
+            buffer.stop()  # the sender thread ends in any case
+    logger.info('stream', sends=buffer.sends, bytes=buffer.sent_bytes)
     # print('msg: ', msg)
-    return msg
+    return buffer.msg, usage
     
 def sendMessage(id, body):
+    if id in gone_connections:
+        raise ConnectionGoneError(id)
     try:
-        client.post_to_connection(
-            ConnectionId=id, 
-            Data=json.dumps(body)
-        )
-    except Exception:
-        err_msg = traceback.format_exc()
-        print('err_msg: ', err_msg)
+        data = json.dumps(body)
+        with trace.span('WebsocketSendLatency'):
+            get_client('apigatewaymanagementapi', endpoint_url=connection_url).post_to_connection(
+                ConnectionId=id, 
+                Data=data
+            )
+        trace.count('WebsocketSends')
+        trace.count('WebsocketBytes', len(data), 'Bytes')
+    except Exception as error:
+        if getattr(error, 'response', {}).get('Error', {}).get('Code') == 'GoneException':
+            logger.info('the connection is gone', connection_id=id)
+            gone_connections.add(id)
+            raise ConnectionGoneError(id)
+        logger.exception('Not able to send a message')
         raise Exception ("Not able to send a message")
 
 def sendResultMessage(connectionId, requestId, msg):    
@@ -334,104 +1080,185 @@ def sendErrorMessage(connectionId, requestId, msg):
         'msg': msg,
         'status': 'error'
     }
-    print('error: ', json.dumps(errorMsg))
+    logger.error('error message', msg=msg)
     sendMessage(connectionId, errorMsg)    
 
 def load_chat_history(userId, allowTime):
-    dynamodb_client = boto3.client('dynamodb')
-
-    response = dynamodb_client.query(
-        TableName=callLogTableName,
-        KeyConditionExpression='user_id = :userId AND request_time > :allowTime',
-        ExpressionAttributeValues={
+    dynamodb_client = get_client('dynamodb')
+
+    # only the last k turns are used by the memory, so read the newest items first and stop early
+    turns = []
+    documents = None
+    limit = memory_chain.k
+    consumed = 0.0
+    pages = 0
+    request = {
+        'TableName': callLogTableName,
+        'KeyConditionExpression': 'user_id = :userId AND request_time > :allowTime',
+        'ExpressionAttributeValues': {
             ':userId': {'S': userId},
             ':allowTime': {'S': allowTime}
-        }
-    )
-    # print('query result: ', response['Items'])
-
-    for item in response['Items']:
-        text = item['body']['S']
-        msg = item['msg']['S']
-        type = item['type']['S']
-
-        if type == 'text':
-            memory_chain.chat_memory.add_user_message(text)
-            if len(msg) > MSG_LENGTH:
-                memory_chain.chat_memory.add_ai_message(msg[:MSG_LENGTH])                          
-            else:
-                memory_chain.chat_memory.add_ai_message(msg)     
-
-def translate_text(chat, text):
-    system = (
-        "You are a helpful assistant that translates {input_language} to {output_language} in <article> tags. Put it in <result> tags."
-    )
-    human = "<article>{text}</article>"
-    
-    prompt = ChatPromptTemplate.from_messages([("system", system), ("human", human)])
-    print('prompt: ', prompt)
-    
-    if isKorean(text)==False :
-        input_language = "English"
-        output_language = "Korean"
-    else:
-        input_language = "Korean"
-        output_language = "English"
-                        
-    chain = prompt | chat    
-    try: 
-        result = chain.invoke(
-            {
-                "input_language": input_language,
-                "output_language": output_language,
-                "text": text,
-            }
-        )
-        msg = result.content
-        print('translated text: ', msg)
-    except Exception:
-        err_msg = traceback.format_exc()
-        print('error message: ', err_msg)                    
-        raise Exception ("Not able to request to LLM")
-
-    return msg[msg.find('<result>')+8:len(msg)-9] # remove <result> tag
-
-def check_grammer(chat, text):
-    if isKorean(text)==True:
-        system = (
-            "다음의 <article> tag안의 문장의 오류를 찾아서 설명하고, 오류가 수정된 문장을 답변 마지막에 추가하여 주세요."
-        )
-    else: 
-        system = (
-            "Here is pieces of article, contained in <article> tags. Find the error in the sentence and explain it, and add the corrected sentence at the end of your answer."
-        )
-        
-    human = "<article>{text}</article>"
-    
-    prompt = ChatPromptTemplate.from_messages([("system", system), ("human", human)])
-    print('prompt: ', prompt)
-    
-    chain = prompt | chat    
-    try: 
-        result = chain.invoke(
-            {
-                "text": text
-            }
-        )
+        },
+        'ProjectionExpression': '#body, #msg, #type, #status, #summary, #summary_turns, #summary_tokens, #documents',
+        'ExpressionAttributeNames': {  # type is a reserved word of dynamodb
+            '#body': 'body',
+            '#msg': 'msg',
+            '#type': 'type',
+            '#status': 'status',
+            '#summary': 'summary',
+            '#summary_turns': 'summary_turns',
+            '#summary_tokens': 'summary_tokens',
+            '#documents': 'documents'
+        },
+        'ScanIndexForward': False,
+        'Limit': memory_chain.k,
+        'ReturnConsumedCapacity': 'TOTAL'
+    }
+    while True:
+        response = dynamodb_client.query(**request)
+        pages = pages + 1
+        if 'ConsumedCapacity' in response:
+            consumed = consumed + response['ConsumedCapacity']['CapacityUnits']
+
+        for item in response['Items']:
+            if documents is None and item.get('status', {}).get('S') != 'in_progress':  # the newest item has the documents of the session
+                documents = item.get('documents', {}).get('SS', [])
+
+            if item['type']['S'] == 'text' and item.get('status', {}).get('S') != 'in_progress':  # not the claim of a running request
+                turns.append((item['body']['S'], item['msg']['S']))
+
+                # the newest summary covers the turns before the ones which were kept with it
+                if memory_mode == 'summary' and not memory_chain.summary and 'summary' in item:
+                    memory_chain.summary = item['summary']['S']
+                    memory_chain.summarized_tokens = int(item['summary_tokens']['N'])
+                    limit = min(limit, len(turns) - 1 + int(item['summary_turns']['N']))
         
-        msg = result.content
-        print('result of grammer correction: ', msg)
-    except Exception:
-        err_msg = traceback.format_exc()
-        print('error message: ', err_msg)                    
-        raise Exception ("Not able to request to LLM")
-    
-    return msg
+        if len(turns) >= limit or 'LastEvaluatedKey' not in response:
+            break
+        request['ExclusiveStartKey'] = response['LastEvaluatedKey']
+    logger.info('history', turns=len(turns[:limit]), pages=pages, consumed_capacity=consumed, summary=bool(memory_mode == 'summary' and memory_chain.summary), documents=len(documents or []))
 
-def extract_sentiment(chat, text):
-    if isKorean(text)==True:
-        system = (
-            """아래의 <example> review와 Extracted Topic and sentiment 인 <result>가 있습니다.
+    for key in documents or []:
+        add_user_document(userId, key)
+    
+    for text, msg in reversed(turns[:limit]):  # the oldest one first
+        memory_chain.chat_memory.add_user_message(text)
+        if memory_mode == 'window' and len(msg) > MSG_LENGTH:
+            memory_chain.chat_memory.add_ai_message(msg[:MSG_LENGTH])                          
+        else:
+            memory_chain.chat_memory.add_ai_message(msg)     
+
+def parse_result(msg):
+    # the text in <result> tags, or the whole message if the model didn't use the tags
+    start = msg.find('<result>')
+    if start < 0:
+        return msg.strip()
+    end = msg.find('</result>', start)
+    if end < 0:
+        end = len(msg)
+    return msg[start+8:end].strip()
+
+result_wait_chars = int(os.environ.get('result_wait_chars', '300'))  # the answer is streamed as it is if there is no tag in this length
+
+def partial_tag(text, tag):
+    # the length of the end of text which can be the beginning of tag
+    for n in range(min(len(text), len(tag)-1), 0, -1):
+        if tag.startswith(text[-n:]):
+            return n
+    return 0
+
+class TagFilter:
+    # Forwards only the text in <tag> tags of a streamed answer, as parse_result does for the whole answer.
+    # A tag can be split across the chunks, so the end of the text which can be the beginning of a tag is held back.
+    # If the opening tag doesn't appear in the first result_wait_chars characters, the answer is forwarded as it is.
+    def __init__(self, tag):
+        self.open_tag = f"<{tag}>"
+        self.close_tag = f"</{tag}>"
+        self.state = 'before'  # before, inside, after or passthrough
+        self.buffer = ""
+        self.started = False  # the leading spaces in the tags are not forwarded
+
+    def feed(self, text):
+        self.buffer = self.buffer + text
+        if self.state == 'before':
+            start = self.buffer.find(self.open_tag)
+            if start >= 0:
+                self.buffer = self.buffer[start+len(self.open_tag):]
+                self.state = 'inside'
+            elif len(self.buffer) > result_wait_chars and not partial_tag(self.buffer, self.open_tag):
+                self.state = 'passthrough'
+            else:
+                return ""
+
+        if self.state == 'inside':
+            end = self.buffer.find(self.close_tag)
+            if end >= 0:
+                out = self.buffer[:end]
+                self.buffer = ""
+                self.state = 'after'
+            else:
+                keep = partial_tag(self.buffer, self.close_tag)
+                out = self.buffer[:len(self.buffer)-keep]
+                self.buffer = self.buffer[len(self.buffer)-keep:]
+            if not self.started:
+                out = out.lstrip()
+                self.started = len(out) > 0
+            return out
+
+        out = self.buffer if self.state == 'passthrough' else ""
+        self.buffer = ""
+        return out
+
+    def finish(self):
+        # the rest of the answer, which is the whole answer if there was no tag
+        out = self.buffer if self.state != 'after' else ""
+        self.buffer = ""
+        return out.lstrip() if self.state == 'inside' and not self.started else out
+
+# Every task declares its system prompt (per language if it differs), the human prompt, the output parser,
+# whether the answer is streamed and the tag whose text is streamed. The prompts are built once per container, so a new task only needs an entry here.
+tasks = {
+    'normal': {
+        'system': {
+            'ko': "다음의 Human과 Assistant의 친근한 이전 대화입니다. Assistant은 상황에 맞는 구체적인 세부 정보를 충분히 제공합니다. Assistant의 이름은 서연이고, 모르는 질문을 받으면 솔직히 모른다고 말합니다.",
+            'en': "Using the following conversation, answer friendly for the newest question. If you don't know the answer, just say that you don't know, don't try to make up an answer. You will be acting as a thoughtful advisor."
+        },
+        'human': "{input}",
+        'history': True,
+        'streaming': True
+    },
+    'qa': {  # normal conversation with the chunks of the uploaded documents which are retrieved for the question
+        'system': {
+            'ko': "다음의 Human과 Assistant의 친근한 이전 대화와 <context> tag안의 업로드된 문서의 일부입니다. Assistant은 문서의 내용을 참조하여 상황에 맞는 구체적인 세부 정보를 충분히 제공합니다. Assistant의 이름은 서연이고, 모르는 질문을 받으면 솔직히 모른다고 말합니다.",
+            'en': "Using the following conversation and the passages of the uploaded documents in <context> tags, answer friendly for the newest question. If you don't know the answer, just say that you don't know, don't try to make up an answer. You will be acting as a thoughtful advisor."
+        },
+        'human': "<context>{context}</context>\n\n{input}",
+        'history': True,
+        'streaming': True,
+        'internal': True
+    },
+    'translation': {
+        'system': "You are a helpful assistant that translates {input_language} to {output_language} in <article> tags. Put it in <result> tags.",
+        'partial': {
+            'ko': {'input_language': "Korean", 'output_language': "English"},
+            'en': {'input_language': "English", 'output_language': "Korean"}
+        },
+        'human': "<article>{input}</article>",
+        'parser': parse_result,
+        'streaming': True,
+        'stream_tag': 'result'
+    },
+    'grammar': {
+        'system': {
+            'ko': "다음의 <article> tag안의 문장의 오류를 찾아서 설명하고, 오류가 수정된 문장을 답변 마지막에 추가하여 주세요.",
+            'en': "Here is pieces of article, contained in <article> tags. Find the error in the sentence and explain it, and add the corrected sentence at the end of your answer."
+        },
+        'human': "<article>{input}</article>",
+        'streaming': True
+    },
+    'sentiment': {
+        'system': {
+            'ko': """아래의 <example> review와 Extracted Topic and sentiment 인 <result>가 있습니다.
             <example>
             객실은 작지만 깨끗하고 편안합니다. 프론트 데스크는 정말 분주했고 체크인 줄도 길었지만, 직원들은 프로페셔널하고 매우 유쾌하게 각 사람을 응대했습니다. 우리는 다시 거기에 머물것입니다.
             </example>
@@ -440,11 +1267,8 @@ def extract_sentiment(chat, text):
             서비스: 긍정적
             </result>
 
-            아래의 <review>에 대해서 위의 <result> 예시처럼 Extracted Topic and sentiment 을 만들어 주세요."""
-        )
-    else: 
-        system = (
-            """Here is <example> review and extracted topics and sentiments as <result>.
+            아래의 <review>에 대해서 위의 <result> 예시처럼 Extracted Topic and sentiment 을 만들어 주세요.""",
+            'en': """Here is <example> review and extracted topics and sentiments as <result>.
 
             <example>
             The room was small but clean and comfortable. The front desk was really busy and the check-in line was long, but the staff were professional and very pleasant with each person they helped. We will stay there again.
@@ -454,140 +1278,49 @@ def extract_sentiment(chat, text):
             Cleanliness: Positive, 
             Service: Positive
             </result>"""
-        )
-        
-    human = "<review>{text}</review>"
-    
-    prompt = ChatPromptTemplate.from_messages([("system", system), ("human", human)])
-    print('prompt: ', prompt)
-    
-    chain = prompt | chat    
-    try: 
-        result = chain.invoke(
-            {
-                "text": text
-            }
-        )        
-        msg = result.content                
-        print('result of sentiment extraction: ', msg)
-        
-    except Exception:
-        err_msg = traceback.format_exc()
-        print('error message: ', err_msg)                    
-        raise Exception ("Not able to request to LLM")
-    
-    return msg
-
-def extract_information(chat, text):
-    if isKorean(text)==True:
-        system = (
-            """다음 텍스트에서 이메일 주소를 정확하게 복사하여 한 줄에 하나씩 적어주세요. 입력 텍스트에 정확하게 쓰여있는 이메일 주소만 적어주세요. 텍스트에 이메일 주소가 없다면, "N/A"라고 적어주세요. 또한 결과는 <result> tag를 붙여주세요."""
-        )
-    else: 
-        system = (
-            """Please precisely copy any email addresses from the following text and then write them, one per line.  Only write an email address if it's precisely spelled out in the input text. If there are no email addresses in the text, write "N/A".  Do not say anything else.  Put it in <result> tags."""
-        )
-        
-    human = "<text>{text}</text>"
-    
-    prompt = ChatPromptTemplate.from_messages([("system", system), ("human", human)])
-    print('prompt: ', prompt)
-    
-    chain = prompt | chat    
-    try: 
-        result = chain.invoke(
-            {
-                "text": text
-            }
-        )        
-        output = result.content        
-        msg = output[output.find('<result>')+8:len(output)-9] # remove <result> 
-        
-        print('result of information extraction: ', msg)
-    except Exception:
-        err_msg = traceback.format_exc()
-        print('error message: ', err_msg)                    
-        raise Exception ("Not able to request to LLM")
-    
-    return msg
-
-def remove_pii(chat, text):
-    if isKorean(text)==True:
-        system = (
-            """아래의 <text>에서 개인식별정보(PII)를 모두 제거하여 외부 계약자와 안전하게 공유할 수 있도록 합니다. 이름, 전화번호, 주소, 이메일을 XXX로 대체합니다. 또한 결과는 <result> tag를 붙여주세요."""
-        )
-    else: 
-        system = (
-            """We want to de-identify some text by removing all personally identifiable information from this text so that it can be shared safely with external contractors.
+        },
+        'human': "<review>{input}</review>",
+        'streaming': True
+    },
+    'extraction': {  # infomation extraction
+        'system': {
+            'ko': """다음 텍스트에서 이메일 주소를 정확하게 복사하여 한 줄에 하나씩 적어주세요. 입력 텍스트에 정확하게 쓰여있는 이메일 주소만 적어주세요. 텍스트에 이메일 주소가 없다면, "N/A"라고 적어주세요. 또한 결과는 <result> tag를 붙여주세요.""",
+            'en': """Please precisely copy any email addresses from the following text and then write them, one per line.  Only write an email address if it's precisely spelled out in the input text. If there are no email addresses in the text, write "N/A".  Do not say anything else.  Put it in <result> tags."""
+        },
+        'human': "<text>{input}</text>",
+        'parser': parse_result,
+        'streaming': True,
+        'stream_tag': 'result'
+    },
+    'pii': {
+        'system': {
+            'ko': """아래의 <text>에서 개인식별정보(PII)를 모두 제거하여 외부 계약자와 안전하게 공유할 수 있도록 합니다. 이름, 전화번호, 주소, 이메일을 XXX로 대체합니다. 또한 결과는 <result> tag를 붙여주세요.""",
+            'en': """We want to de-identify some text by removing all personally identifiable information from this text so that it can be shared safely with external contractors.
             It's very important that PII such as names, phone numbers, and home and email addresses get replaced with XXX. Put it in <result> tags."""
-        )
-        
-    human = "<text>{text}</text>"
-    
-    prompt = ChatPromptTemplate.from_messages([("system", system), ("human", human)])
-    print('prompt: ', prompt)
-    
-    chain = prompt | chat    
-    try: 
-        result = chain.invoke(
-            {
-                "text": text
-            }
-        )        
-        output = result.content        
-        msg = output[output.find('<result>')+8:len(output)-9] # remove <result> 
-        
-        print('result of removing PII : ', msg)
-    except Exception:
-        err_msg = traceback.format_exc()
-        print('error message: ', err_msg)                    
-        raise Exception ("Not able to request to LLM")
-    
-    return msg
-
-def do_step_by_step(chat, text):
-    if isKorean(text)==True:
-        system = (
-            """다음은 Human과 Assistant의 친근한 대화입니다. Assistant은 상황에 맞는 구체적인 세부 정보를 충분히 제공합니다. 아래 문맥(context)을 참조했음에도 답을 알 수 없다면, 솔직히 모른다고 말합니다. 여기서 Assistant의 이름은 서연입니다.
+        },
+        'human': "<text>{input}</text>",
+        'parser': parse_result,
+        'streaming': True,
+        'stream_tag': 'result'
+    },
+    'step-by-step': {
+        'system': {
+            'ko': """다음은 Human과 Assistant의 친근한 대화입니다. Assistant은 상황에 맞는 구체적인 세부 정보를 충분히 제공합니다. 아래 문맥(context)을 참조했음에도 답을 알 수 없다면, 솔직히 모른다고 말합니다. 여기서 Assistant의 이름은 서연입니다.
 
             Assistant: 단계별로 생각할까요?
 
-            Human: 예, 그렇게하세요."""
-        )
-    else: 
-        system = (
-            """Using the following conversation, answer friendly for the newest question. If you don't know the answer, just say that you don't know, don't try to make up an answer. You will be acting as a thoughtful advisor. 
+            Human: 예, 그렇게하세요.""",
+            'en': """Using the following conversation, answer friendly for the newest question. If you don't know the answer, just say that you don't know, don't try to make up an answer. You will be acting as a thoughtful advisor. 
             
             Assistant: Can I think step by step?
 
             Human: Yes, please do."""
-        )
-        
-    human = "<text>{text}</text>"
-    
-    prompt = ChatPromptTemplate.from_messages([("system", system), ("human", human)])
-    print('prompt: ', prompt)
-    
-    chain = prompt | chat    
-    try: 
-        result = chain.invoke(
-            {
-                "text": text
-            }
-        )        
-        msg = result.content        
-        
-        print('result of sentiment extraction: ', msg)
-    except Exception:
-        err_msg = traceback.format_exc()
-        print('error message: ', err_msg)                    
-        raise Exception ("Not able to request to LLM")
-    
-    return msg
-
-def extract_timestamp(chat, text):
-    system = (
-        """Human: 아래의 <text>는 시간을 포함한 텍스트입니다. 친절한 AI Assistant로서 시간을 추출하여 아래를 참조하여 <example>과 같이 정리해주세요.
+        },
+        'human': "<text>{input}</text>",
+        'streaming': True
+    },
+    'timestamp-extraction': {
+        'system': """Human: 아래의 <text>는 시간을 포함한 텍스트입니다. 친절한 AI Assistant로서 시간을 추출하여 아래를 참조하여 <example>과 같이 정리해주세요.
             
         - 년도를 추출해서 <year>/<year>로 넣을것 
         - 월을 추출해서 <month>/<month>로 넣을것
@@ -607,72 +1340,296 @@ def extract_timestamp(chat, text):
             <minute>26</minute>
         </result>
 
-        결과에 개행문자인 "\n"과 글자 수와 같은 부가정보는 절대 포함하지 마세요."""
-    )    
-        
-    human = "<text>{text}</text>"
+        결과에 개행문자인 "\n"과 글자 수와 같은 부가정보는 절대 포함하지 마세요.""",
+        'human': "<text>{input}</text>",
+        'parser': parse_result,
+        'streaming': True,
+        'stream_tag': 'result'
+    },
+
+    # the stages of the summarization which are not selected by convType
+    'summary': {
+        'system': {
+            'ko': "다음의 <article> tag안의 문장을 요약해서 500자 이내로 설명하세오.",
+            'en': "Here is pieces of article, contained in <article> tags. Write a concise summary within 500 characters."
+        },
+        'human': "<article>{input}</article>",
+        'internal': True
+    },
+    'summary-map': {
+        'system': {
+            'ko': "다음의 <article> tag안의 문장은 긴 문서의 일부입니다. 중요한 내용이 빠지지 않도록 요약하세요.",
+            'en': "Here is a part of a long article, contained in <article> tags. Write a summary which keeps the important details."
+        },
+        'human': "<article>{input}</article>",
+        'internal': True
+    },
+    'summary-combine': {
+        'system': {
+            'ko': "다음의 <article> tag안의 문장은 긴 문서의 부분별 요약입니다. 중요한 내용이 빠지지 않도록 하나의 요약으로 합치세요.",
+            'en': "Here are summaries of the parts of a long article, contained in <article> tags. Combine them into one summary which keeps the important details."
+        },
+        'human': "<article>{input}</article>",
+        'internal': True
+    },
+    'summary-refine': {
+        'system': {
+            'ko': "<summary> tag안의 문장은 문서의 앞부분에 대한 요약입니다. <article> tag안의 이어지는 문장을 반영하여 요약을 500자 이내로 수정하세요.",
+            'en': "Here is a summary of the beginning of an article in <summary> tags, and the following part of the article in <article> tags. Refine the summary with the following part within 500 characters."
+        },
+        'human': "<summary>{summary}</summary>\n<article>{input}</article>",
+        'internal': True
+    },
+    'summary-history': {  # rolling summary of the conversation for the summary memory
+        'system': {
+            'ko': "<summary> tag안의 문장은 이전 대화의 요약입니다. <history> tag안의 이어지는 대화를 반영하여 요약을 500자 이내로 수정하세요. 사용자가 알려준 사실과 요청은 유지합니다.",
+            'en': "Here is a summary of the earlier conversation in <summary> tags, and the following turns of the conversation in <history> tags. Update the summary with the following turns within 500 characters. Keep the facts and the requests which the user told."
+        },
+        'human': "<summary>{summary}</summary>\n<history>{input}</history>",
+        'internal': True
+    },
+}
+
+LANGUAGES = ['ko', 'en']
+
+def build_prompt(task, language):
+    from langchain_core.prompts import MessagesPlaceholder, ChatPromptTemplate
+    system = task['system'] if isinstance(task['system'], str) else task['system'][language]
+    messages = [("system", system)]
+    if task.get('history'):
+        messages.append(MessagesPlaceholder(variable_name="history"))
+    messages.append(("human", task['human']))
     
-    prompt = ChatPromptTemplate.from_messages([("system", system), ("human", human)])
-    print('prompt: ', prompt)
+    prompt = ChatPromptTemplate.from_messages(messages)
+    if 'partial' in task:
+        prompt = prompt.partial(**task['partial'][language])
+    return prompt
+
+prompts = dict()  # (task, language): prompt which is built once when it is used first
+
+def get_prompt(name, language):
+    prompt = prompts.get((name, language))
+    if prompt is None:
+        prompt = build_prompt(tasks[name], language)
+        prompts[(name, language)] = prompt
+    return prompt
+
+if os.environ.get('eager_init', 'false') == 'true':  # with provisioned concurrency, the init phase is not seen by the users
+    for name in tasks:
+        for language in LANGUAGES:
+            get_prompt(name, language)
+    get_chat()
+
+def run_task(connectionId, requestId, name, language, inputs):
+    task = tasks[name]
+    with trace.span('PromptBuild'):
+        if task.get('history'):
+            inputs["history"] = memory_chain.load_memory_variables({})["chat_history"]
+        messages = get_prompt(name, language).invoke(inputs)
     
-    chain = prompt | chat    
     try: 
-        result = chain.invoke(
-            {
-                "text": text
-            }
-        )        
-        output = result.content        
-        msg = output[output.find('<result>')+8:len(output)-9] # remove <result> 
+        start = time.time()
+        if task.get('streaming') and connectionId is not None:
+            isTyping(connectionId, requestId)  
+            stream = get_chat().stream(messages)
+            msg, usage = readStreamMsg(connectionId, requestId, stream, task.get('stream_tag'))
+        else:
+            result = get_chat().invoke(messages)
+            msg = result.content
+            usage = result.usage_metadata
+        trace.record('GenerationDuration', start)
+            
+        if usage:
+            logger.info('token usage', prompt_tokens=usage['input_tokens'], completion_tokens=usage['output_tokens'], total_tokens=usage['total_tokens'])
+            trace.count('InputTokens', usage['input_tokens'])
+            trace.count('OutputTokens', usage['output_tokens'])
+        
+        if task.get('history') and memory_mode == 'summary':
+            saved = memory_chain.saved_tokens()
+            logger.info('memory', history_tokens=memory_chain.sent_tokens, saved_tokens=saved, prompt_tokens=usage['input_tokens'] if usage else None)
+            trace.count('PromptTokensSaved', saved)
         
-        print('result of sentiment extraction: ', msg)
+        if task.get('parser'):
+            msg = task['parser'](msg)
+    except ConnectionGoneError:  # before the generation
+        raise CancelledError("")
+    except CancelledError:
+        raise
     except Exception:
-        err_msg = traceback.format_exc()
-        print('error message: ', err_msg)                    
+        logger.exception('Not able to request to LLM')
         raise Exception ("Not able to request to LLM")
     
+    logger.debug('result', task=name, msg=msg)
     return msg
 
+deferred = []  # the jobs which are run after the result is sent
+
+def run_deferred():
+    while deferred:
+        job = deferred.pop(0)
+        try:
+            job()
+        except Exception:  # the result was already sent
+            logger.exception('Not able to run the deferred job')
+
+def fold_memory(userId, memory, language, item):
+    # the summary is kept with the call log of the request, so that load_chat_history of other containers can use it
+    def summarize(summary, text):
+        return run_task(None, None, 'summary-history', language, {"summary": summary, "input": text})
+
+    with trace.span('MemoryFold'):
+        folded = memory.fold(summarize)
+    if folded:
+        map_chain.put(userId, memory)
+        item['summary'] = {'S': memory.summary}
+        item['summary_turns'] = {'N': str(len(memory.chat_memory.messages)//2)}
+        item['summary_tokens'] = {'N': str(memory.summarized_tokens)}
+        call_log.put(item)
+        logger.info('memory fold', summary_turns=len(memory.chat_memory.messages)//2, summarized_tokens=memory.summarized_tokens)
+
+def report_cancelled(msg):
+    # the output tokens which were not generated, up to the max tokens of the model
+    generated = estimate_tokens(msg)
+    parameters = get_parameter(served_model()) or {}
+    max_tokens = parameters.get('max_tokens', parameters.get('maxTokenCount', 0))
+    saved = max(0, max_tokens - generated)
+
+    logger.info('cancelled', generated_tokens=generated, saved_tokens_max=saved, saved_cost_max=round(saved*output_token_price/1000, 6))
+    trace.count('CancelledRequests')
+    trace.count('CancelledTokensSaved', saved)
+
+def complete_request(connectionId, requestId, item, msg, status):
+    # the result is written over the claim, and sent to the connections which sent the request again
+    global claimed
+    try:
+        subscribers = request_registry.complete(item)
+    except Exception:
+        logger.exception('Not able to complete the request')
+        call_log.put(item)
+        subscribers = []
+    claimed = None
+
+    for subscriber in dict.fromkeys(subscribers + resumed_connections):  # in order without the duplicates
+        if subscriber == connectionId:
+            continue
+        try:
+            if status == 'completed':
+                sendResultMessage(subscriber, requestId, msg)
+            else:
+                sendErrorMessage(subscriber, requestId, "The request was cancelled. Please send it again.")
+        except Exception:  # the subscriber may be gone too
+            logger.info('not able to send the result to the subscriber', subscriber=subscriber)
+
+def finish_request(connectionId, requestId):
+    # called after the result is sent, or when it could not be sent since the connection is gone
+    global completion
+    if completion is not None:
+        item, msg, status = completion
+        completion = None
+        with trace.span('DynamoDBWrite'):
+            complete_request(connectionId, requestId, item, msg, status)
+
+def release_request(connectionId, requestId):
+    # the claim of a request which failed is removed, so that it can be sent again
+    global claimed
+    for subscriber in request_registry.abandon(claimed, connectionId):
+        try:
+            sendErrorMessage(subscriber, requestId, "Not able to get the response. Please send it again.")
+        except Exception:
+            logger.info('not able to send the error to the subscriber', subscriber=subscriber)
+    claimed = None
+
+def resumeStream(connectionId, jsonBody):
+    # the client reconnected in the middle of an answer and asks for the messages after last_seq
+    requestId = jsonBody['request_id']
+    request = {
+        'user_id': {'S':jsonBody['user_id']},
+        'request_id': {'S':requestId},
+        'request_time': {'S':jsonBody['request_time']}
+    }
+    seq = int(jsonBody.get('last_seq', -1)) + 1
+    logger.info('resume', seq=seq)
+
+    state, msg = request_registry.resume(request, connectionId, seq)
+    if state == 'running':  # the owner sends the missing messages at its next checkpoint
+        isTyping(connectionId, requestId)
+    elif state == 'completed':
+        sendResultMessage(connectionId, requestId, msg)
+    else:
+        sendErrorMessage(connectionId, requestId, "Not able to resume the answer. Please send it again.")
+
 def getResponse(connectionId, jsonBody):
-    print('jsonBody: ', jsonBody)
-    
     userId  = jsonBody['user_id']
-    print('userId: ', userId)
     requestId  = jsonBody['request_id']
-    print('requestId: ', requestId)
     requestTime  = jsonBody['request_time']
-    print('requestTime: ', requestTime)
     type  = jsonBody['type']
-    print('type: ', type)
     body = jsonBody['body']
-    print('body: ', body)
     convType = jsonBody['convType']
-    print('convType: ', convType)
+    logger.info('request', user_id=userId, request_time=requestTime, type=type, convType=convType)
+    logger.debug('body', body=body)
     
-    global map_chain, memory_chain
+    global map_chain, memory_chain, claimed, completion
+
+    if dedupe:
+        request = {
+            'user_id': {'S':userId},
+            'request_id': {'S':requestId},
+            'request_time': {'S':requestTime},
+            'type': {'S':type},
+            'body': {'S':body}
+        }
+        try:
+            state, msg = request_registry.claim(request, connectionId)
+            if state == 'running':
+                state, msg = request_registry.subscribe(request, connectionId)
+        except Exception:  # the request is answered without the dedupe
+            logger.exception('Not able to claim the request')
+            state = None
+        
+        if state == 'owner':
+            claimed = request
+        elif state is None:  # another request of the user in the same second
+            logger.info('the request is answered without the dedupe')
+        else:
+            trace.count('DuplicateRequests')
+            if state == 'running':
+                logger.info('duplicated request, attached to the running generation')
+                isTyping(connectionId, requestId)
+                return None  # the owner sends the result
+            logger.info('duplicated request, the stored answer is sent')
+            return msg
 
     # create memory
-    if userId in map_chain:  
-        print('memory exist. reuse it!')        
-        memory_chain = map_chain[userId]
-    else: 
-        print('memory does not exist. create new one!')        
-        memory_chain = ConversationBufferWindowMemory(memory_key="chat_history", output_key='answer', return_messages=True, k=10)
-        map_chain[userId] = memory_chain
-
-        allowTime = getAllowTime()
-        load_chat_history(userId, allowTime)
+    with trace.span('MemoryHydration'):
+        memory_chain = map_chain.get(userId)
+        if memory_chain is not None:  
+            logger.debug('memory exist. reuse it!')
+        else: 
+            logger.debug('memory does not exist. create new one!')
+            if memory_mode == 'summary':
+                from summary_memory import SummaryBufferMemory
+                memory_chain = SummaryBufferMemory(max_tokens=memory_max_tokens, count_tokens=estimate_tokens, k=memory_load_turns)
+            else:
+                from langchain.memory import ConversationBufferWindowMemory
+                memory_chain = ConversationBufferWindowMemory(memory_key="chat_history", output_key='answer', return_messages=True, k=10)
+
+            allowTime = getAllowTime()
+            load_chat_history(userId, allowTime)
+            map_chain.put(userId, memory_chain)
+    logger.info('memory store', stats=map_chain.stats())
     
-    start = int(time.time())    
+    start = time.time()
 
     msg = ""
+    status = 'completed'
+    index_key = None  # of the document which is indexed after the result is sent
     if type == 'text' and body[:11] == 'list models':
-        bedrock_client = boto3.client(
+        bedrock_client = get_client(
             service_name='bedrock',
             region_name=bedrock_region,
         )
         modelInfo = bedrock_client.list_foundation_models()    
-        print('models: ', modelInfo)
+        logger.debug('models', models=modelInfo)
 
         msg = f"The list of models: \n"
         lists = modelInfo['modelSummaries']
@@ -681,90 +1638,113 @@ def getResponse(connectionId, jsonBody):
             msg += f"{model['modelId']}\n"
         
         msg += f"current model: {modelId}"
-        print('model lists: ', msg)    
+        logger.debug('model lists', msg=msg)
     else:             
         if type == 'text':
             text = body
-            print('query: ', text)
+            logger.debug('query', text=text)
 
             querySize = len(text)
             textCount = len(text.split())
-            print(f"query size: {querySize}, words: {textCount}")
+            logger.info('query size', size=querySize, words=textCount)
 
             if text == 'clearMemory':
                 memory_chain.clear()
-                map_chain[userId] = memory_chain
+                map_chain.put(userId, memory_chain)
+                user_documents.pop(userId, None)
                     
-                print('initiate the chat memory!')
+                logger.info('initiate the chat memory!')
                 msg  = "The chat memory was intialized in this session."
             else:            
-                if convType == "normal":
-                    msg = general_conversation(connectionId, requestId, chat, text)    
-                elif convType == "translation":
-                    msg = translate_text(chat, text) 
-                elif convType == "grammar":
-                    msg = check_grammer(chat, text)  
-                elif convType == "sentiment":
-                    msg = extract_sentiment(chat, text)
-                elif convType == "extraction": # infomation extraction
-                    msg = extract_information(chat, text)  
-                elif convType == "pii":
-                    msg = remove_pii(chat, text)   
-                elif convType == "step-by-step":
-                    msg = do_step_by_step(chat, text)  
-                elif convType == "timestamp-extraction":
-                    msg = extract_timestamp(chat, text)  
+                language = getLanguage(text)  # detected once per request
+                trace.set_dimension('language', language)
+                if convType not in tasks or tasks[convType].get('internal'):
+                    convType = "normal"
+                    trace.set_dimension('convType', convType)
+                
+                key = None
+                if convType in cache_conv_types and not jsonBody.get('bypass_cache', False):
+                    key = cache_key(convType, modelId, get_parameter(modelId), language, text)
+                    msg = response_cache.get(key)
+                    logger.info('response cache', stats=response_cache.stats())
+                
+                if msg:
+                    logger.info('cached response is used')
                 else:
-                    msg = general_conversation(connectionId, requestId, chat, text)  
-                    
-                memory_chain.chat_memory.add_user_message(text)
-                memory_chain.chat_memory.add_ai_message(msg)
+                    name = convType
+                    inputs = {"input": text}
+                    if convType == 'normal' and retrieval and user_documents.get(userId):
+                        try:
+                            context = retrieve(userId, text)
+                        except Exception:  # answered without the documents
+                            logger.exception('Not able to retrieve the chunks')
+                            context = ""
+                        if context:
+                            name = 'qa'
+                            inputs["context"] = context
+                    try:
+                        msg = run_task(connectionId, requestId, name, language, inputs)
+                    except CancelledError as cancelled:  # the partial answer is kept
+                        msg = cancelled.msg
+                        status = 'cancelled'
+                
+                if key and msg and status == 'completed' and served_model() == modelId:  # the key is of modelId
+                    response_cache.put(key, msg)
+                
+                if msg:
+                    memory_chain.chat_memory.add_user_message(text)
+                    memory_chain.chat_memory.add_ai_message(msg)
+                    map_chain.put(userId, memory_chain)
                                         
         elif type == 'document':
             isTyping(connectionId, requestId)
             
             object = body
             file_type = object[object.rfind('.')+1:len(object)]            
-            print('file_type: ', file_type)
+            logger.info('file type', file_type=file_type)
             
-            if file_type == 'csv':
-                docs = load_csv_document(path, doc_prefix, object)
-                contexts = []
-                for doc in docs:
-                    contexts.append(doc.page_content)
-                print('contexts: ', contexts)
-
-                msg = get_summary(chat, contexts)
-                        
-            elif file_type == 'pdf' or file_type == 'txt' or file_type == 'md' or file_type == 'pptx' or file_type == 'docx':
-                texts = load_document(file_type, object)
-
-                docs = []
-                for i in range(len(texts)):
-                    docs.append(
-                        Document(
-                            page_content=texts[i],
-                            metadata={
-                                'name': object,
-                                # 'page':i+1,
-                                'uri': path+doc_prefix+parse.quote(object)
-                            }
-                        )
-                    )
-                print('docs[0]: ', docs[0])    
-                print('docs size: ', len(docs))
-
-                contexts = []
-                for doc in docs:
-                    contexts.append(doc.page_content)
-                print('contexts: ', contexts)
-
-                msg = get_summary(chat, contexts)
+            try:
+                if file_type == 'csv' or file_type in document_loaders:
+                    # the etag of the object validates the cached chunks and summary
+                    head = get_client('s3').head_object(Bucket=s3_bucket, Key=s3_prefix+'/'+object)
+                    source = (s3_bucket, s3_prefix+'/'+object, head['ETag'])
+                    summary_key = document_key(*source, 'summary', modelId, get_parameter(modelId), summary_mode, summary_max_input_tokens)
+                    
+                    chunks_key = document_key(*source, 'chunks', SPLIT_VERSION, document_max_chars, csv_sample_mode, csv_sample_rows, csv_sample_threshold)
+                    
+                    cached = document_cache.get(summary_key)
+                    if cached is not None:
+                        msg = cached['summary']
+                        logger.info('cached summary is used', stats=document_cache.stats())
+                    else:
+                        chunks = document_cache.get(chunks_key)
+                        logger.info('document cache', chunks=chunks is not None, stats=document_cache.stats())
+                        if chunks is not None:
+                            segments = chunks
+                        elif file_type == 'csv':
+                            segments = cache_chunks(chunks_key, sample_csv_rows(object))
+                        else:
+                            segments = cache_chunks(chunks_key, load_document(file_type, object))
+                        contexts = (text for text, metadata in segments)  # streamed into the summarization
+
+                        msg = get_summary(connectionId, requestId, contexts)
+                        document_cache.put(summary_key, {'summary': msg})
+                    
+                    if document_cache.pending:  # the s3 tier is written after the result is sent
+                        deferred.append(document_cache.upload)
+                    
+                    if retrieval:  # the chunks are embedded after the result is sent
+                        index_key = document_key(chunks_key, 'index', embedding_model_id, retrieval_max_chunks)
                 
-        elapsed_time = int(time.time()) - start
-        print("total run time(sec): ", elapsed_time)
-        
-        print('msg: ', msg)
+            except CancelledError as cancelled:
+                msg = cancelled.msg
+                status = 'cancelled'
+            except ConnectionGoneError:  # while sending the progress
+                status = 'cancelled'
+                
+        elapsed_time = time.time() - start
+        logger.info('total run time', elapsed=round(elapsed_time, 3))
+        logger.debug('msg', msg=msg)
 
         item = {
             'user_id': {'S':userId},
@@ -774,15 +1754,21 @@ def getResponse(connectionId, jsonBody):
             'body': {'S':body},
             'msg': {'S':msg}
         }
+        if user_documents.get(userId):  # the documents of the session, for the containers which load the history
+            item['documents'] = {'SS':user_documents[userId]}
+        if index_key is not None and status == 'completed':
+            deferred.append(lambda: index_document(userId, index_key, chunks_key, file_type, object, item))
+        if status == 'cancelled':
+            item['status'] = {'S':status}
+            report_cancelled(msg)
+
+        if claimed is not None:  # written over the claim after the result is sent
+            completion = (item, msg, status)
+        else:
+            call_log.put(item)  # written in background after the result is sent
 
-        client = boto3.client('dynamodb')
-        try:
-            resp =  client.put_item(TableName=callLogTableName, Item=item)
-        except Exception:
-            err_msg = traceback.format_exc()
-            print('error message: ', err_msg)
-            raise Exception ("Not able to write into dynamodb")               
-        #print('resp, ', resp)
+        if memory_mode == 'summary' and type == 'text' and body != 'clearMemory' and status == 'completed':  # the older turns are summarized after the reply is sent
+            deferred.append(lambda memory=memory_chain: fold_memory(userId, memory, language, item))
 
     return msg
 
@@ -794,9 +1780,9 @@ def lambda_handler(event, context):
         routeKey = event['requestContext']['routeKey']
         
         if routeKey == '$connect':
-            print('connected!')
+            logger.info('connected!', connection_id=connectionId)
         elif routeKey == '$disconnect':
-            print('disconnected!')
+            logger.info('disconnected!', connection_id=connectionId)
         else:
             body = event.get("body", "")
             #print("data[0:8]: ", body[0:8])
@@ -804,25 +1790,58 @@ def lambda_handler(event, context):
                 # print("keep alive!")                
                 sendMessage(connectionId, "__pong__")
             else:
-                print('connectionId: ', connectionId)
-                print('routeKey: ', routeKey)
-        
                 jsonBody = json.loads(body)
-                print('request body: ', json.dumps(jsonBody))
 
                 requestId  = jsonBody['request_id']
+                logger.start(request_id=requestId, connection_id=connectionId)
+                logger.info('route', route_key=routeKey)
+                logger.debug('request body', body=jsonBody)
+
+                if routeKey == 'resume' or jsonBody.get('action') == 'resume':  # the $default route before the resume route is deployed
+                    try:
+                        resumeStream(connectionId, jsonBody)
+                    except ConnectionGoneError:
+                        logger.info('the connection is gone')
+                    finally:
+                        gone_connections.clear()
+                    return {
+                        'statusCode': 200
+                    }
+
+                trace.start(requestId, convType=jsonBody.get('convType'), modelId=modelId, language=None)
                 try:
                     msg = getResponse(connectionId, jsonBody)
                     # print('msg: ', msg)
                     
-                    sendResultMessage(connectionId, requestId, msg)  
+                    if msg is not None:  # None when the request is attached to the running one
+                        sendResultMessage(connectionId, requestId, msg)  
+
+                    finish_request(connectionId, requestId)
+                    run_deferred()
+                
+                except ConnectionGoneError:
+                    logger.info('the result is not sent since the connection is gone')
                                         
                 except Exception:
                     err_msg = traceback.format_exc()
-                    print('err_msg: ', err_msg)
+                    logger.error('Not able to get the response', error=err_msg)
 
-                    sendErrorMessage(connectionId, requestId, err_msg)    
+                    trace.count('Errors')
+                    if connectionId not in gone_connections:
+                        sendErrorMessage(connectionId, requestId, err_msg)    
                     raise Exception ("Not able to send a message")
+                
+                finally:  # the container is frozen after return
+                    finish_request(connectionId, requestId)  # the result which was not sent is kept for the subscribers
+                    if claimed is not None:  # the request failed or is not logged
+                        release_request(connectionId, requestId)
+                    deferred.clear()
+                    gone_connections.clear()
+                    resumed_connections.clear()
+                    with trace.span('DynamoDBWrite'):
+                        call_log.flush()
+                        response_cache.flush()
+                    trace.emit()
 
     return {
         'statusCode': 200
@@ -0,0 +1,66 @@
+import os
+import json
+import time
+import random
+import traceback
+
+# Structured logging: every line is a json object with the level, the message, the fields of the current request
+# such as request_id, and the fields of the call. The fields are truncated, so a line has a bounded size at INFO level.
+# The verbose payloads (prompts, documents and answers) are logged at DEBUG level, or for the sampled requests.
+LEVELS = {'DEBUG': 10, 'INFO': 20, 'WARNING': 30, 'ERROR': 40}
+
+log_level = LEVELS.get(os.environ.get('log_level', 'INFO').upper(), LEVELS['INFO'])
+log_max_field = int(os.environ.get('log_max_field', '256'))  # characters of a field
+log_max_error = int(os.environ.get('log_max_error', '4096'))  # characters of a traceback
+log_sample_rate = float(os.environ.get('log_sample_rate', '0'))  # ratio of the requests which are logged at DEBUG level
+
+context = dict()
+sampled = False
+
+def start(**fields):
+    # called at the beginning of a request, the fields are added to every line until the next request
+    global sampled
+    context.clear()
+    context.update(fields)
+    sampled = random.random() < log_sample_rate
+
+def enabled(level):
+    return LEVELS[level] >= log_level or sampled
+
+def truncate(value, limit):
+    if value is None or isinstance(value, (bool, int, float)):
+        return value
+    if not isinstance(value, str):
+        value = json.dumps(value, ensure_ascii=False, default=str)
+    if len(value) > limit:
+        return value[:limit] + f"...({len(value)} chars)"
+    return value
+
+def log(level, message, **fields):
+    if not enabled(level):
+        return
+    line = {
+        'time': round(time.time(), 3),
+        'level': level,
+        'message': message,
+        **context
+    }
+    for name, value in fields.items():
+        line[name] = truncate(value, log_max_error if name == 'error' else log_max_field)
+    print(json.dumps(line, ensure_ascii=False))
+
+def debug(message, **fields):
+    log('DEBUG', message, **fields)
+
+def info(message, **fields):
+    log('INFO', message, **fields)
+
+def warning(message, **fields):
+    log('WARNING', message, **fields)
+
+def error(message, **fields):
+    log('ERROR', message, **fields)
+
+def exception(message, **fields):
+    # called in an except block to log the traceback
+    log('ERROR', message, error=traceback.format_exc(), **fields)
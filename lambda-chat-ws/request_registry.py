@@ -0,0 +1,207 @@
+import time
+import threading
+
+from collections import OrderedDict
+from botocore.exceptions import ClientError
+from aws_clients import get_client
+import logger
+
+IN_PROGRESS = 'in_progress'
+
+def is_condition_failed(error):
+    return isinstance(error, ClientError) and error.response.get('Error', {}).get('Code') == 'ConditionalCheckFailedException'
+
+def is_same_request(existing, item):
+    # the key of the call log is (user_id, request_time) whose time is in seconds, so two requests of a user in
+    # a second have the same key. The dedupe works only for the request which made the item.
+    return existing.get('request_id', {}).get('S') == item['request_id']['S']
+
+def parse_resumes(attributes):
+    # "connection id|next seq" of the connections which asked to resume the stream
+    resumes = []
+    for resume in attributes.get('resumes', {}).get('SS', []):
+        connectionId, seq = resume.rsplit('|', 1)
+        resumes.append((connectionId, int(seq)))
+    return resumes
+
+class RequestRegistry:
+    # single owner of a request_id across the containers. The owner claims the call log item of the request with a
+    # conditional write before the model is invoked, so that a request which is sent again after a reconnection is
+    # answered by the stored msg or attached to the running generation instead of generating the answer again.
+    # The claim has a lease, so a request whose owner died is taken over after the lease. Another request which has
+    # the same key is reported with the None state, and is answered without the dedupe.
+    def __init__(self, table_name, keys, lease, max_recent=1000):
+        self.table_name = table_name
+        self.keys = keys  # the key attributes of the table
+        self.lease = lease  # seconds
+        self.max_recent = max_recent
+        self.recent = OrderedDict()  # request_id: msg of the requests which were completed in this container
+        self.lock = threading.Lock()
+
+    def key(self, item):
+        return {key: item[key] for key in self.keys}
+
+    def remember(self, requestId, msg):
+        with self.lock:
+            self.recent[requestId] = msg
+            self.recent.move_to_end(requestId)
+            while len(self.recent) > self.max_recent:
+                self.recent.popitem(last=False)
+
+    def claim(self, item, connectionId):
+        # returns ('owner', None), ('completed', msg), ('running', None) or (None, None) for another request of the key
+        requestId = item['request_id']['S']
+        with self.lock:
+            msg = self.recent.get(requestId)
+        if msg is not None:
+            return 'completed', msg
+
+        now = int(time.time())
+        claim = {
+            **item,
+            'msg': {'S': ''},
+            'status': {'S': IN_PROGRESS},
+            'owner': {'S': connectionId},
+            'lease_until': {'N': str(now + self.lease)}
+        }
+        dynamodb_client = get_client('dynamodb')
+        try:
+            # a new request, a request whose owner is gone after the lease, or a request which was cancelled
+            dynamodb_client.put_item(
+                TableName=self.table_name,
+                Item=claim,
+                ConditionExpression=f"attribute_not_exists({self.keys[0]}) OR #status = :in_progress AND lease_until < :now AND request_id = :request_id OR #status = :cancelled AND request_id = :request_id",
+                ExpressionAttributeNames={'#status': 'status'},  # status is a reserved word of dynamodb
+                ExpressionAttributeValues={
+                    ':in_progress': {'S': IN_PROGRESS},
+                    ':cancelled': {'S': 'cancelled'},
+                    ':now': {'N': str(now)},
+                    ':request_id': {'S': requestId}
+                }
+            )
+            return 'owner', None
+        except Exception as error:
+            if not is_condition_failed(error):
+                raise
+
+        existing = dynamodb_client.get_item(TableName=self.table_name, Key=self.key(item), ConsistentRead=True).get('Item')
+        if existing is None:  # deleted by the owner which failed since then
+            return self.claim(item, connectionId)
+        if not is_same_request(existing, item):
+            return None, None
+        if existing.get('status', {}).get('S') == IN_PROGRESS:
+            return 'running', None
+        return 'completed', existing['msg']['S']
+
+    def subscribe(self, item, connectionId):
+        # the connection gets the result from the owner. Returns ('running', None), ('completed', msg) if the request
+        # was completed meanwhile, or (None, None) if the item is gone or belongs to another request.
+        try:
+            get_client('dynamodb').update_item(
+                TableName=self.table_name,
+                Key=self.key(item),
+                UpdateExpression='ADD subscribers :connection',
+                ConditionExpression='#status = :in_progress AND request_id = :request_id',
+                ExpressionAttributeNames={'#status': 'status'},
+                ExpressionAttributeValues={
+                    ':connection': {'SS': [connectionId]},
+                    ':in_progress': {'S': IN_PROGRESS},
+                    ':request_id': item['request_id']
+                }
+            )
+            return 'running', None
+        except Exception as error:
+            if not is_condition_failed(error):
+                raise
+
+        existing = get_client('dynamodb').get_item(TableName=self.table_name, Key=self.key(item), ConsistentRead=True).get('Item')
+        if existing is None or not is_same_request(existing, item):
+            return None, None
+        return 'completed', existing['msg']['S']
+
+    def resume(self, item, connectionId, seq):
+        # asks the owner to send the stream from seq to the connection at its next checkpoint.
+        # Returns ('running', None), ('completed', msg), ('cancelled', msg) or (None, None) when the request is unknown.
+        try:
+            get_client('dynamodb').update_item(
+                TableName=self.table_name,
+                Key=self.key(item),
+                UpdateExpression='ADD resumes :resume',
+                ConditionExpression='#status = :in_progress AND request_id = :request_id',
+                ExpressionAttributeNames={'#status': 'status'},
+                ExpressionAttributeValues={
+                    ':resume': {'SS': [f"{connectionId}|{seq}"]},
+                    ':in_progress': {'S': IN_PROGRESS},
+                    ':request_id': item['request_id']
+                }
+            )
+            return 'running', None
+        except Exception as error:
+            if not is_condition_failed(error):
+                raise
+
+        existing = get_client('dynamodb').get_item(TableName=self.table_name, Key=self.key(item), ConsistentRead=True).get('Item')
+        if existing is None or not is_same_request(existing, item):
+            return None, None
+        return existing.get('status', {}).get('S', 'completed'), existing['msg']['S']
+
+    def checkpoint(self, item, owner, msg, seq):
+        # saves the text which was streamed up to seq, and takes the resumes which were asked since the last checkpoint.
+        # The text is kept in partial, since msg is read as the finished answer by lambda-query and lambda-gethistory.
+        # Returns None if the request is not owned any more.
+        try:
+            response = get_client('dynamodb').update_item(
+                TableName=self.table_name,
+                Key=self.key(item),
+                UpdateExpression='SET #partial = :partial, #seq = :seq REMOVE resumes',
+                ConditionExpression='#status = :in_progress AND #owner = :owner AND request_id = :request_id',
+                ExpressionAttributeNames={'#partial': 'partial', '#seq': 'seq', '#status': 'status', '#owner': 'owner'},
+                ExpressionAttributeValues={
+                    ':partial': {'S': msg},
+                    ':seq': {'N': str(seq)},
+                    ':in_progress': {'S': IN_PROGRESS},
+                    ':owner': {'S': owner},
+                    ':request_id': item['request_id']
+                },
+                ReturnValues='ALL_OLD'
+            )
+        except Exception as error:
+            if is_condition_failed(error):
+                return None
+            raise
+        return parse_resumes(response.get('Attributes', {}))
+
+    def complete(self, item):
+        # writes the result over the claim and returns the connections which subscribed or asked to resume until then.
+        # The later ones fail on the condition and read the result themselves, so none is missed.
+        response = get_client('dynamodb').put_item(
+            TableName=self.table_name,
+            Item=item,
+            ReturnValues='ALL_OLD'
+        )
+        if 'status' not in item:  # a cancelled request is generated again
+            self.remember(item['request_id']['S'], item['msg']['S'])
+        attributes = response.get('Attributes', {})
+        return attributes.get('subscribers', {}).get('SS', []) + [connectionId for connectionId, seq in parse_resumes(attributes)]
+
+    def abandon(self, item, connectionId):
+        # removes the claim of the failed request, so that it can be sent again, and returns the waiting connections
+        try:
+            response = get_client('dynamodb').delete_item(
+                TableName=self.table_name,
+                Key=self.key(item),
+                ConditionExpression='#status = :in_progress AND #owner = :owner AND request_id = :request_id',
+                ExpressionAttributeNames={'#status': 'status', '#owner': 'owner'},
+                ExpressionAttributeValues={
+                    ':in_progress': {'S': IN_PROGRESS},
+                    ':owner': {'S': connectionId},
+                    ':request_id': item['request_id']
+                },
+                ReturnValues='ALL_OLD'
+            )
+        except Exception as error:
+            if not is_condition_failed(error):
+                logger.exception('Not able to remove the claim of the request')
+            return []
+        attributes = response.get('Attributes', {})
+        return attributes.get('subscribers', {}).get('SS', []) + [connectionId for connectionId, seq in parse_resumes(attributes)]
@@ -0,0 +1,112 @@
+import json
+import time
+import hashlib
+import unicodedata
+import threading
+
+from collections import OrderedDict
+from aws_clients import get_client
+from call_log import BatchWriter
+import logger
+
+def normalize_text(text):
+    # the same input with different line endings or trailing spaces has the same key
+    text = unicodedata.normalize('NFC', text).replace('\r\n', '\n')
+    return '\n'.join(line.rstrip() for line in text.strip().split('\n'))
+
+def cache_key(convType, modelId, model_kwargs, language, text):
+    key = json.dumps({
+        'convType': convType,
+        'modelId': modelId,
+        'model_kwargs': model_kwargs,
+        'language': language,
+        'text': hashlib.sha256(normalize_text(text).encode('utf-8')).hexdigest()
+    }, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+class ResponseCache:
+    # two tier cache for the answers: LRU in the container and an optional dynamodb table shared by containers
+    def __init__(self, max_items, max_bytes, table_name=None, ttl=24*60*60, on_event=None):
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.table_name = table_name
+        self.ttl = ttl
+        self.entries = OrderedDict()  # key: (msg, expire time)
+        self.total_bytes = 0
+        self.lock = threading.Lock()
+        self.writer = BatchWriter(table_name, keys=['cache_key']) if table_name else None
+        self.local_hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+        self.on_event = on_event  # called with the name of the hit and miss events
+
+    def event(self, name):
+        if self.on_event is not None:
+            self.on_event(name)
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                if entry[1] > time.time():
+                    self.entries.move_to_end(key)
+                    self.local_hits = self.local_hits + 1
+                    self.event('ResponseCacheLocalHits')
+                    return entry[0]
+                self.remove(key)
+
+        if self.table_name:
+            try:
+                response = get_client('dynamodb').get_item(
+                    TableName=self.table_name,
+                    Key={'cache_key': {'S': key}},
+                    ProjectionExpression='#msg, #ttl',
+                    ExpressionAttributeNames={'#msg': 'msg', '#ttl': 'ttl'}  # ttl is a reserved word of dynamodb
+                )
+                item = response.get('Item')
+                if item and int(item['ttl']['N']) > time.time():  # expired items are deleted lazily by dynamodb
+                    msg = item['msg']['S']
+                    self.store(key, msg, int(item['ttl']['N']))
+                    self.shared_hits = self.shared_hits + 1
+                    self.event('ResponseCacheSharedHits')
+                    return msg
+            except Exception:
+                logger.exception('Not able to read the response cache')
+
+        self.misses = self.misses + 1
+
+        self.event('ResponseCacheMisses')
+        return None
+
+    def put(self, key, msg):
+        expire = int(time.time()) + self.ttl
+        self.store(key, msg, expire)
+
+        if self.writer is not None:
+            self.writer.put({
+                'cache_key': {'S': key},
+                'msg': {'S': msg},
+                'ttl': {'N': str(expire)}
+            })
+
+    def store(self, key, msg, expire):
+        with self.lock:
+            self.remove(key)
+            self.entries[key] = (msg, expire)
+            self.total_bytes = self.total_bytes + len(msg.encode('utf-8'))
+            while len(self.entries) > 1 and (len(self.entries) > self.max_items or self.total_bytes > self.max_bytes):
+                self.remove(next(iter(self.entries)))
+
+    def remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.total_bytes = self.total_bytes - len(entry[0].encode('utf-8'))
+
+    def flush(self):
+        if self.writer is not None:
+            self.writer.flush()
+
+    def stats(self):
+        requests = self.local_hits + self.shared_hits + self.misses
+        hit_rate = (self.local_hits + self.shared_hits) / requests if requests else 0
+        return f"items: {len(self.entries)}, bytes: {self.total_bytes}, local hits: {self.local_hits}, shared hits: {self.shared_hits}, misses: {self.misses}, hit rate: {hit_rate:.2f}"
@@ -0,0 +1,74 @@
+from langchain_core.chat_history import InMemoryChatMessageHistory
+from langchain_core.messages import HumanMessage, AIMessage
+
+class SummaryBufferMemory:
+    # Keeps the recent turns verbatim within max_tokens and folds the older turns into a rolling summary.
+    # fold() calls the LLM, so it is run after the reply is sent. Until then the prompt only takes the newest
+    # turns which fit in the budget, so the history in a prompt is bounded by max_tokens and the summary.
+    def __init__(self, max_tokens, count_tokens, k=20):
+        self.max_tokens = max_tokens
+        self.count_tokens = count_tokens  # text: estimated tokens
+        self.k = k  # the turns which are loaded from the call log
+        self.chat_memory = InMemoryChatMessageHistory()
+        self.summary = ""
+        self.summarized_tokens = 0  # tokens of the turns in the summary
+        self.sent_tokens = 0  # tokens of the history in the last prompt
+
+    def load_memory_variables(self, inputs):
+        # the newest messages within the budget, the older ones are summarized by fold()
+        messages = []
+        tokens = 0
+        for message in reversed(self.chat_memory.messages):
+            size = self.count_tokens(message.content)
+            if messages and tokens + size > self.max_tokens:
+                break
+            messages.insert(0, message)
+            tokens = tokens + size
+        if messages and not isinstance(messages[0], HumanMessage):  # a turn starts with the human message
+            tokens = tokens - self.count_tokens(messages.pop(0).content)
+
+        if self.summary:  # anthropic models only allow a system message at the beginning, so the summary is a turn
+            messages = [
+                HumanMessage(content=f"Here is the summary of our earlier conversation.\n<summary>{self.summary}</summary>"),
+                AIMessage(content="I will keep it in mind.")
+            ] + messages
+            tokens = tokens + self.count_tokens(self.summary)
+
+        self.sent_tokens = tokens
+        return {"chat_history": messages}
+
+    def saved_tokens(self):
+        # the tokens which a full buffer of the same turns would have sent more than the last prompt
+        full = self.summarized_tokens + sum(self.count_tokens(message.content) for message in self.chat_memory.messages)
+        return max(0, full - self.sent_tokens)
+
+    def overflow(self):
+        # the oldest turns which are out of the budget
+        messages = self.chat_memory.messages
+        tokens = sum(self.count_tokens(message.content) for message in messages)
+        n = 0
+        while n < len(messages)-2 and tokens > self.max_tokens:
+            for message in messages[n:n+2]:
+                tokens = tokens - self.count_tokens(message.content)
+            n = n + 2
+        return messages[:n]
+
+    def fold(self, summarize):
+        # summarize(summary, text) returns the updated summary, the folded turns are removed only after it succeeds
+        folded = self.overflow()
+        if not folded:
+            return False
+
+        lines = []
+        for message in folded:
+            lines.append(("Human: " if isinstance(message, HumanMessage) else "Assistant: ") + message.content)
+        self.summary = summarize(self.summary, "\n".join(lines))
+        self.summarized_tokens = self.summarized_tokens + sum(self.count_tokens(message.content) for message in folded)
+        del self.chat_memory.messages[:len(folded)]
+        return True
+
+    def clear(self):
+        self.chat_memory.clear()
+        self.summary = ""
+        self.summarized_tokens = 0
+        self.sent_tokens = 0
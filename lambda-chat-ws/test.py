@@ -1,5 +1,11 @@
-import numpy as np
+import os
+import json
 import time
+
+# runs a request with the local stand-ins of bench_handler, or with the deployed resources when test_live is true
+live = os.environ.get('test_live', 'false') == 'true'
+if not live:
+    import bench_handler
 from lambda_function import lambda_handler  
 
 def load_event():
@@ -11,11 +17,26 @@ def load_event():
         "body": "Building a website can be done in 10 simple steps.",
         "convType": "normal"
     }
-    return json_data
+    # the event of the $default route of the websocket api
+    return {
+        "requestContext": {
+            "connectionId": os.environ.get('test_connection_id', 'test-connection'),
+            "routeKey": "$default"
+        },
+        "body": json.dumps(json_data)
+    }
 
 def main():
     start = time.time()
 
+    if not live:
+        api = bench_handler.FakeApiGateway(latency=0)
+        bench_handler.install(
+            bench_handler.FakeBedrock(token_rate=200, first_token_latency=0.2, answer_tokens=50),
+            api,
+            bench_handler.FakeDynamoDB({bench_handler.lambda_function.callLogTableName: ('user_id', 'request_time')}, latency=0)
+        )
+
     # load samples
     event = load_event()
 
@@ -24,7 +45,10 @@ def main():
     
     # results
     print(results['statusCode'])
-    print(results['msg'])
+    if not live:  # the messages which were sent to the client
+        for sent, connectionId, data in api.calls:
+            message = json.loads(data)
+            print(message['status'], message['msg'])
 
     print('Elapsed time: %0.2fs' % (time.time()-start))   
 
@@ -0,0 +1,84 @@
+import json
+import time
+import random
+import threading
+
+from contextlib import contextmanager
+
+class Trace:
+    # collects the spans and counters of a request and prints them as a CloudWatch embedded metric format (EMF) line,
+    # so that cloudwatch extracts the metrics from the log without PutMetricData calls.
+    def __init__(self, namespace, sample_rate=0.0):
+        self.namespace = namespace
+        self.sample_rate = sample_rate  # the ratio of the requests whose spans are printed
+        self.lock = threading.Lock()  # the summarization records from the worker threads
+        self.start(None)
+
+    def start(self, requestId, **dimensions):
+        self.requestId = requestId
+        self.dimensions = dimensions
+        self.started = time.time()
+        self.metrics = dict()  # name: [value, unit]
+        self.spans = []  # (name, start offset, duration)
+        self.sampled = random.random() < self.sample_rate
+
+    def set_dimension(self, name, value):
+        self.dimensions[name] = value
+
+    @contextmanager
+    def span(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.record(name, start)
+
+    def record(self, name, start):
+        # the durations of the spans with the same name are added up
+        end = time.time()
+        with self.lock:
+            self.add(name, (end-start)*1000, 'Milliseconds')
+            if self.sampled:
+                self.spans.append((name, (start-self.started)*1000, (end-start)*1000))
+
+    def count(self, name, value=1, unit='Count'):
+        with self.lock:
+            self.add(name, value, unit)
+
+    def maximum(self, name, value, unit='Count'):
+        # the largest value in the request, for the gauges such as a queue depth
+        with self.lock:
+            if name not in self.metrics or value > self.metrics[name][0]:
+                self.metrics[name] = [value, unit]
+
+    def add(self, name, value, unit):
+        if name in self.metrics:
+            self.metrics[name][0] = self.metrics[name][0] + value
+        else:
+            self.metrics[name] = [value, unit]
+
+    def emit(self):
+        if self.requestId is None:
+            return
+        self.record('HandlerLatency', self.started)
+
+        # every dimension needs a value, otherwise cloudwatch drops the metrics
+        dimensions = {name: str(value) if value else 'none' for name, value in self.dimensions.items()}
+        log = {
+            '_aws': {
+                'Timestamp': int(self.started*1000),
+                'CloudWatchMetrics': [{
+                    'Namespace': self.namespace,
+                    'Dimensions': [list(dimensions)],
+                    'Metrics': [{'Name': name, 'Unit': unit} for name, (value, unit) in self.metrics.items()]
+                }]
+            },
+            'request_id': self.requestId,
+            **dimensions,
+            **{name: round(value, 3) for name, (value, unit) in self.metrics.items()}
+        }
+        print(json.dumps(log))
+
+        if self.sampled:
+            spans = [{'name': name, 'start': round(start, 3), 'duration': round(duration, 3)} for name, start, duration in self.spans]
+            print(json.dumps({'trace': self.requestId, **dimensions, 'spans': spans}))
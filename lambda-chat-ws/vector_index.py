@@ -0,0 +1,138 @@
+import os
+import re
+import json
+import gzip
+import shutil
+import hashlib
+import threading
+import numpy as np
+
+from collections import OrderedDict
+from aws_clients import get_client
+import logger
+
+LOCAL_DIMENSION = 1024
+pattern_word = re.compile(r'\w+')
+
+def normalize(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+def hash_embedding(texts, dimension=LOCAL_DIMENSION):
+    # deterministic stand-in of an embedding model for the tests: the words, and the character bigrams of the words
+    # which are not ascii since Korean has no spaces in a phrase, are hashed into the dimensions with a sign. The counts
+    # are damped by log and the longer words weigh more, so the texts which share the rare words are close rather than
+    # the ones which share the filler. The scores are lower than the ones of a real model.
+    vectors = np.zeros((len(texts), dimension), dtype=np.float32)
+    for i, text in enumerate(texts):
+        counts = dict()
+        for word in pattern_word.findall(text.lower()):
+            features = [word] if word.isascii() else [word] + [word[j:j+2] for j in range(len(word)-1)]
+            for feature in features:
+                counts[feature] = counts.get(feature, 0) + 1
+        for feature, count in counts.items():
+            digest = int.from_bytes(hashlib.blake2b(feature.encode('utf-8'), digest_size=8).digest(), 'little')
+            weight = (1.0 + np.log(count)) * min(len(feature), 10)  # the longer words are the rarer ones
+            vectors[i, digest % dimension] += weight if (digest >> 32) & 1 else -weight
+    return normalize(vectors)
+
+class VectorIndex:
+    # the normalized embeddings of the chunks as a float32 matrix, so that the cosine similarity of a query to every
+    # chunk is a matrix vector product. The matrix is saved as .npy, which is memory mapped when it is loaded.
+    def __init__(self, vectors, chunks):
+        self.vectors = vectors  # (chunks, dimension) float32, or a read only memory map
+        self.chunks = chunks  # [text, metadata]
+
+    def search(self, vector, k):
+        # returns [(score, text, metadata)] of the top k chunks
+        if not len(self.chunks):
+            return []
+        scores = self.vectors @ np.asarray(vector, dtype=np.float32)
+        k = min(k, len(scores))
+        top = np.argpartition(-scores, k-1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(float(scores[i]), self.chunks[i][0], self.chunks[i][1]) for i in top]
+
+    def nbytes(self):
+        return self.vectors.nbytes + sum(len(text.encode('utf-8')) for text, metadata in self.chunks)
+
+    def save(self, path):
+        np.save(path + '.npy', np.ascontiguousarray(self.vectors, dtype=np.float32))
+        with gzip.open(path + '.json.gz', 'wt', encoding='utf-8') as f:
+            json.dump(self.chunks, f, ensure_ascii=False)
+
+    @classmethod
+    def load(cls, path):
+        vectors = np.load(path + '.npy', mmap_mode='r')  # the pages are read when they are used
+        with gzip.open(path + '.json.gz', 'rt', encoding='utf-8') as f:
+            chunks = json.load(f)
+        return cls(vectors, chunks)
+
+class IndexStore:
+    # the indexes of the documents: LRU in the process bounded by max_bytes, the files in /tmp which are memory mapped,
+    # and an optional s3 prefix which is shared by the containers, so a cold container downloads the files only.
+    FILES = ['.npy', '.json.gz']
+
+    def __init__(self, directory, max_bytes, bucket=None, prefix=None):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.bucket = bucket
+        self.prefix = prefix
+        self.indexes = OrderedDict()  # key: (index, bytes)
+        self.total_bytes = 0
+        self.lock = threading.Lock()
+        shutil.rmtree(directory, ignore_errors=True)  # the files of a previous process are not accounted
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, key):
+        return os.path.join(self.directory, key)
+
+    def get(self, key):
+        with self.lock:
+            entry = self.indexes.get(key)
+            if entry is not None:
+                self.indexes.move_to_end(key)
+                return entry[0]
+
+        if self.prefix is None:
+            return None
+        try:
+            for suffix in self.FILES:
+                get_client('s3').download_file(self.bucket, self.prefix + key + suffix, self.path(key) + suffix)
+        except Exception as error:
+            if getattr(error, 'response', {}).get('Error', {}).get('Code') not in ['NoSuchKey', '404']:
+                logger.exception('Not able to load the index', key=key)
+            return None
+        index = VectorIndex.load(self.path(key))
+        self.store(key, index)
+        return index
+
+    def put(self, key, index):
+        index.save(self.path(key))
+        index = VectorIndex.load(self.path(key))  # the memory map instead of the matrix in the memory
+        self.store(key, index)
+        if self.prefix is not None:
+            for suffix in self.FILES:
+                get_client('s3').upload_file(self.path(key) + suffix, self.bucket, self.prefix + key + suffix)
+        return index
+
+    def store(self, key, index):
+        size = index.nbytes()
+        with self.lock:
+            entry = self.indexes.pop(key, None)
+            if entry is not None:
+                self.total_bytes = self.total_bytes - entry[1]
+            self.indexes[key] = (index, size)
+            self.total_bytes = self.total_bytes + size
+            while len(self.indexes) > 1 and self.total_bytes > self.max_bytes:
+                oldest, (evicted, evicted_size) = self.indexes.popitem(last=False)
+                self.total_bytes = self.total_bytes - evicted_size
+                for suffix in self.FILES:
+                    try:
+                        os.remove(self.path(oldest) + suffix)
+                    except OSError:
+                        pass
+
+    def stats(self):
+        return f"indexes: {len(self.indexes)}, bytes: {self.total_bytes}"
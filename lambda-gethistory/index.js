@@ -30,6 +30,8 @@ exports.handler = async (event, context) => {
         let history = [];
         for(let item of result['Items']) {
             console.log('item: ', item);
+            if(item['status']) continue;  // the claim of a running request or a cancelled answer
+
             let request_time = item['request_time']['S'];
             let request_id = item['request_id']['S'];
             let body = item['body']['S'];
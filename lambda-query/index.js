@@ -34,7 +34,8 @@ exports.handler = async (event, context) => {
         console.log('result: ', JSON.stringify(result));
 
         isCompleted = true;
-        if(result['Items'][0])
+        // the claim of a running request and a cancelled answer are not the finished answer
+        if(result['Items'][0] && !result['Items'][0]['status'])
             msg = result['Items'][0]['msg']['S'];
 
         console.log('msg: ', msg);   